@@ -1,10 +1,12 @@
 from PyQt5.QtWidgets import QVBoxLayout, QWidget, QLabel, QMessageBox, QSizePolicy
 from qfluentwidgets import SearchLineEdit, TextEdit, StateToolTip
 from PyQt5.QtGui import QFont, QColor, QTextCharFormat, QSyntaxHighlighter
-from PyQt5.QtCore import Qt, QRegExp, QThread, pyqtSignal
+from PyQt5.QtCore import Qt, QEvent, QRegExp, QThread, pyqtSignal
 import requests
 from PyQt5.QtCore import QTimer
 
+NUM_CANDIDATES = 3  # 每次请求的候选数，结果区域中按 ALT+] / ALT+[ 在本地切换
+
 
 class FlowLayout(QVBoxLayout):
     def __init__(self, parent=None, margin=0, spacing=-1):
@@ -108,7 +110,7 @@ class RequestThread(QThread):
         """线程中的代码，发送网络请求并返回结果"""
         try:
             url = "http://127.0.0.1:8000/generate_code/"
-            response = requests.post(url, json={"function_name": self.function_name})
+            response = requests.post(url, json={"function_name": self.function_name, "num_candidates": NUM_CANDIDATES})
 
             if response.status_code == 200:
                 data = response.json()
@@ -146,8 +148,15 @@ class CodeCompletionInterface(QWidget):
         # self.generated_code_display.setFixedWidth(1000)
         self.highlighter = PythonHighlighter(self.generated_code_display.document())  # 初始化时传入高亮器
         self.vBoxLayout.addWidget(self.generated_code_display)
+        self.generated_code_display.installEventFilter(self)
+
+        # 候选序号提示
+        self.candidate_label = QLabel(self)
+        self.vBoxLayout.addWidget(self.candidate_label)
 
         self.state_tooltip = None  # 状态提示初始化为空
+        self.candidates = []  # 排序后的候选代码
+        self.candidate_index = 0
 
         self.resize(800, 600)
 
@@ -178,11 +187,30 @@ class CodeCompletionInterface(QWidget):
         if "error" in result:
             QMessageBox.warning(self, "错误", result["error"])  # 请求失败时弹出错误消息
         else:
-            generated_code = result.get("generated_code")
-            self.generated_code_display.setPlainText(generated_code)  # 显示生成的代码
+            candidates = result.get("candidates") or [{"code": result.get("generated_code")}]
+            self.candidates = [candidate["code"] for candidate in candidates]
+            self.show_candidate(0)  # 显示排名第一的候选
 
             # 更新状态提示为“模型训练完成”
             if self.state_tooltip:
                 self.state_tooltip.setContent('代码生成成功😆')
                 self.state_tooltip.setState(True)
                 self.state_tooltip = None  # 请求完成后隐藏状态提示
+
+    def eventFilter(self, obj, event):
+        """在结果区域中按 ALT+] / ALT+[ 切换候选"""
+        if obj == self.generated_code_display and event.type() == QEvent.KeyPress:
+            if event.modifiers() == Qt.AltModifier and event.key() in (Qt.Key_BracketRight, Qt.Key_BracketLeft):
+                if self.candidates:
+                    step = 1 if event.key() == Qt.Key_BracketRight else -1
+                    self.show_candidate((self.candidate_index + step) % len(self.candidates))
+                return True
+        return super().eventFilter(obj, event)
+
+    def show_candidate(self, index):
+        self.candidate_index = index
+        self.generated_code_display.setPlainText(self.candidates[index])
+        if len(self.candidates) > 1:
+            self.candidate_label.setText(f"候选 {index + 1}/{len(self.candidates)}（ALT+] / ALT+[ 切换）")
+        else:
+            self.candidate_label.setText("")
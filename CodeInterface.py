@@ -1,6 +1,9 @@
 from PyQt5.QtWidgets import QWidget, QVBoxLayout, QMessageBox, QProgressBar
 from PyQt5.QtCore import Qt, QEvent, QThread, pyqtSignal, QRegExp, QTimer
-from PyQt5.QtGui import QSyntaxHighlighter, QTextCharFormat, QColor, QFont
+from PyQt5.QtGui import QSyntaxHighlighter, QTextCharFormat, QColor, QFont, QTextCursor
+import json
+import threading
+import uuid
 import requests
 from qfluentwidgets import TextEdit  # 假设 TextEdit 来自 qfluentwidgets
 
@@ -56,35 +59,94 @@ class PythonHighlighter(QSyntaxHighlighter):
 
 
 class CodeCompletionThread(QThread):
-    # 定义信号，补全代码、进度和错误信号
+    # 定义信号，补全代码、流式中间结果、进度和错误信号
     completed_code_signal = pyqtSignal(str)
+    partial_code_signal = pyqtSignal(str)
     progress_signal = pyqtSignal(int)
     error_signal = pyqtSignal(str)
 
     def __init__(self, prompt):
         super().__init__()
         self.prompt = prompt  # 要补全的代码
+        self.request_id = uuid.uuid4().hex  # 请求标识，取消补全时使用
+        self.cancelled = False
 
-    def run(self):
-        """ 线程运行的代码 """
-        url = "http://127.0.0.1:8000/complete_code/"
-        payload = {"prompt": self.prompt}
+    def cancel(self):
+        """ 新的按键使本次补全作废：通知后端停止生成，并停止读取结果（在主线程中调用，不等待后端响应） """
+        self.cancelled = True
+        threading.Thread(target=self._send_cancel, daemon=True).start()
 
+    def _send_cancel(self):
         try:
-            response = requests.post(url, json=payload, stream=True)
+            requests.post(f"http://127.0.0.1:8000/cancel/{self.request_id}", timeout=5)
+        except requests.exceptions.RequestException:
+            pass  # 请求已结束或后端不可用时忽略
 
-            # 模拟进度更新
-            for i in range(0, 101, 10):  # 每10%更新一次进度
-                self.progress_signal.emit(i)
-                self.msleep(200)  # 模拟延时，实际可以根据实际情况调整
+    def run(self):
+        """ 线程运行的代码：读取流式接口，逐段显示生成的代码 """
+        url = "http://127.0.0.1:8000/complete_code/stream"
+        payload = {"prompt": self.prompt, "request_id": self.request_id}
 
-            if response.status_code == 200:
-                data = response.json()
-                completed_code = data.get("completed_code", "")
-                self.completed_code_signal.emit(completed_code)  # 发射信号到主线程
-            else:
+        try:
+            response = requests.post(url, json=payload, stream=True)
+            if self.cancelled:
+                response.close()
+                return
+            if response.status_code != 200:
                 error_detail = response.json().get("detail", "未知错误")
                 self.error_signal.emit(error_detail)  # 如果有错误，发射错误信号
+                return
+
+            generated = ""
+            chunks = 0
+            for line in response.iter_lines(decode_unicode=True):
+                if self.cancelled:
+                    response.close()  # 关闭连接，后端检测到断开后同样会停止生成
+                    return
+                if not line or not line.startswith("data: "):
+                    continue
+                event = json.loads(line[len("data: "):])
+                if "error" in event:
+                    self.error_signal.emit(event["error"])
+                    return
+                if event.get("done"):
+                    self.progress_signal.emit(100)
+                    self.completed_code_signal.emit(event.get("completed_code", ""))  # 发射信号到主线程
+                    return
+                generated += event.get("text", "")
+                chunks += 1
+                self.partial_code_signal.emit(self.prompt + generated)
+                # 按已收到的 token 数估算进度（服务端最多生成约 300 个 token）
+                self.progress_signal.emit(min(95, chunks * 100 // 300))
+
+            self.error_signal.emit("生成过程意外中断")
+        except requests.exceptions.ConnectionError:
+            self.error_signal.emit("无法连接到后端服务，请确保 FastAPI 服务器正在运行")
+        except Exception as e:
+            self.error_signal.emit(f"生成代码时出错: {e}")
+
+
+class CandidateThread(QThread):
+    # 一次请求取回多个排序后的补全候选，之后在本地切换，不再请求后端
+    candidates_signal = pyqtSignal(list)
+    error_signal = pyqtSignal(str)
+
+    def __init__(self, prompt, num_candidates=3):
+        super().__init__()
+        self.prompt = prompt
+        self.num_candidates = num_candidates
+
+    def run(self):
+        url = "http://127.0.0.1:8000/complete_code/"
+        payload = {"prompt": self.prompt, "num_candidates": self.num_candidates}
+
+        try:
+            response = requests.post(url, json=payload)
+            if response.status_code != 200:
+                self.error_signal.emit(response.json().get("detail", "未知错误"))
+                return
+            data = response.json()
+            self.candidates_signal.emit(data.get("candidates") or [{"code": data.get("completed_code", "")}])
         except requests.exceptions.ConnectionError:
             self.error_signal.emit("无法连接到后端服务，请确保 FastAPI 服务器正在运行")
         except Exception as e:
@@ -122,7 +184,7 @@ class CodeInterface(QWidget):
         # 创建代码编辑框，使用 qfluentwidgets 的 TextEdit
         self.code_edit = TextEdit(self)
         self.code_edit.setFont(QFont("Consolas", 19))  # 设置代码字体
-        self.code_edit.setPlaceholderText("输入代码片段按CTRL自动补全")  # 设置提示文本
+        self.code_edit.setPlaceholderText("输入代码片段按CTRL自动补全，按ALT+] / ALT+[ 切换补全候选")  # 设置提示文本
         self.code_edit.setFixedHeight(600)
         self.layout.addWidget(self.code_edit)
 
@@ -132,15 +194,80 @@ class CodeInterface(QWidget):
         # 设置代码高亮
         self.highlighter = PythonHighlighter(self.code_edit.document())
 
+        # 补全候选：同一提示的候选只请求一次，之后在本地切换
+        self.candidates = []
+        self.candidate_index = 0
+        self.completion_thread = None  # 进行中的流式补全
+        self.retired_threads = []  # 已取消或已结束、但可能仍在运行的补全线程，保留引用直到 finished
+        self.candidate_thread = None
+
     def eventFilter(self, obj, event):
-        """ 监听 Ctrl 键按下事件 """
+        """ 监听 Ctrl 键按下事件；补全过程中的其他按键会取消本次补全 """
         if obj == self.code_edit and event.type() == QEvent.KeyPress:
             if event.modifiers() == Qt.ControlModifier:  # 判断是否按下了Ctrl键
                 print("Ctrl 键按下，触发补全")
+                self.cancel_completion()
                 self.complete_code()
                 return True  # 返回 True 表示事件已经被处理
+            if event.modifiers() == Qt.AltModifier and event.key() in (Qt.Key_BracketRight, Qt.Key_BracketLeft):
+                self.cancel_completion()
+                self.cycle_candidate(1 if event.key() == Qt.Key_BracketRight else -1)
+                return True
+            if event.key() not in (Qt.Key_Shift, Qt.Key_Alt, Qt.Key_Meta):
+                self.cancel_completion()  # 用户继续输入，正在生成的补全已经过时
         return super().eventFilter(obj, event)
 
+    def cancel_completion(self):
+        """ 取消进行中的流式补全，编辑框保留当前内容 """
+        if self.completion_thread is None:
+            return
+        self.completion_thread.cancel()
+        self.retire_completion_thread()
+        self.reset_progress_bar()
+
+    def retire_completion_thread(self):
+        """ 当前补全线程不再更新编辑框：断开它的结果信号，并在它结束前保留引用
+        （线程可能仍阻塞在 HTTP 读取中，运行中的 QThread 被回收时 Qt 会直接终止程序） """
+        thread, self.completion_thread = self.completion_thread, None
+        for signal in (thread.completed_code_signal, thread.partial_code_signal, thread.error_signal,
+                       thread.progress_signal):
+            signal.disconnect()
+        if thread.isFinished():
+            return
+        self.retired_threads.append(thread)
+        thread.finished.connect(lambda: thread in self.retired_threads and self.retired_threads.remove(thread))
+
+    def cycle_candidate(self, step):
+        """ 切换到下一个 / 上一个补全候选；内容被修改过或还没有候选时先向后端请求候选 """
+        current = self.code_edit.toPlainText()
+        if self.candidates and current == self.candidates[self.candidate_index]["code"]:
+            self.candidate_index = (self.candidate_index + step) % len(self.candidates)
+            self.code_edit.setPlainText(self.candidates[self.candidate_index]["code"])
+            self.code_edit.moveCursor(QTextCursor.End)
+            return
+
+        prompt = current.strip()
+        if not prompt:
+            QMessageBox.warning(self, "输入错误", "请输入代码段")
+            return
+        self.code_edit.setDisabled(True)
+        self.progressBar.setValue(50)
+        self.candidate_thread = CandidateThread(prompt)
+        self.candidate_thread.candidates_signal.connect(self.on_candidates)
+        self.candidate_thread.error_signal.connect(self.on_error)
+        self.candidate_thread.start()
+
+    def on_candidates(self, candidates):
+        """ 显示排名第一的候选 """
+        self.candidates = [candidate for candidate in candidates if candidate.get("code")]
+        self.candidate_index = 0
+        self.code_edit.setEnabled(True)
+        if self.candidates:
+            self.code_edit.setPlainText(self.candidates[0]["code"])
+            self.code_edit.moveCursor(QTextCursor.End)
+        self.progressBar.setValue(100)
+        QTimer.singleShot(2000, self.reset_progress_bar)
+
     def complete_code(self):
         """ 触发代码段补全 """
         prompt = self.code_edit.toPlainText().strip()
@@ -148,18 +275,27 @@ class CodeInterface(QWidget):
             QMessageBox.warning(self, "输入错误", "请输入代码段")
             return
 
-        # 禁用编辑框，防止用户在补全过程中修改内容
-        self.code_edit.setDisabled(True)
-
+        # 补全过程中编辑框保持可用，用户继续输入时取消本次补全
         # 创建并启动后台线程
         self.completion_thread = CodeCompletionThread(prompt)
         self.completion_thread.completed_code_signal.connect(self.on_code_completed)
+        self.completion_thread.partial_code_signal.connect(self.on_partial_code)
         self.completion_thread.error_signal.connect(self.on_error)
         self.completion_thread.progress_signal.connect(self.update_progress_bar)  # 连接进度信号
         self.completion_thread.start()
 
+    def on_partial_code(self, partial_code):
+        """ 流式显示已生成的代码 """
+        if self.sender() is not self.completion_thread:
+            return  # 已取消的补全
+        self.code_edit.setPlainText(partial_code)
+        self.code_edit.moveCursor(QTextCursor.End)
+
     def on_code_completed(self, completed_code):
         """ 处理补全后的代码 """
+        if self.sender() is not self.completion_thread:
+            return
+        self.retire_completion_thread()
         self.code_edit.setPlainText(completed_code)  # 显示补全后的代码
         self.code_edit.setEnabled(True)  # 启用编辑框
         self.progressBar.setValue(100)  # 设置进度条为100%
@@ -169,12 +305,18 @@ class CodeInterface(QWidget):
 
     def on_error(self, error_message):
         """ 处理错误信息 """
+        if self.sender() not in (self.completion_thread, self.candidate_thread):
+            return
+        if self.sender() is self.completion_thread:
+            self.retire_completion_thread()
         QMessageBox.warning(self, "错误", error_message)
         self.code_edit.setEnabled(True)  # 启用编辑框
         self.progressBar.setValue(0)  # 设置进度条为0%
 
     def update_progress_bar(self, value):
         """ 更新进度条的值 """
+        if self.sender() is not self.completion_thread:
+            return  # 已取消的补全在断开信号前发出的进度
         self.progressBar.setValue(value)  # 设置进度条的当前值
 
     def reset_progress_bar(self):
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+
+from cancellation import GenerationCancelled
+from inference_executor import QueueFullError
+
+logger = logging.getLogger(__name__)
+
+
+class BatchScheduler:
+    """动态微批调度器：在时间窗口内收集并发请求，合并为一次批量推理"""
+
+    def __init__(self, batch_fn, executor, max_batch_size=8, max_wait_ms=10, max_queue_size=64):
+        self.batch_fn = batch_fn  # 同步函数 batch_fn(items, cancel_tokens=..., **params)，返回与 items 等长的结果列表
+        self.executor = executor  # 批次在推理执行器的工作线程中运行
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_queue_size = max_queue_size
+        self.pending = 0  # 已提交但尚未返回的请求数
+        self._queue = None
+        self._task = None
+
+    def _ensure_started(self):
+        """在当前事件循环中启动后台调度任务（首次提交时）"""
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, item, timeout=None, cancel=None, **params):
+        """提交单个请求，等待所在批次推理完成后返回该请求的结果
+
+        params 为生成参数，只有参数相同的请求才会合并到同一批次。
+        排队请求数超过上限时抛出 QueueFullError，等待超过 timeout 秒抛出 asyncio.TimeoutError；
+        cancel 为 CancelToken，排队期间被取消时抛出 GenerationCancelled，生成期间被取消时该序列提前停止
+        """
+        if self.pending >= self.max_queue_size:
+            raise QueueFullError("推理队列已满，请稍后重试")
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self.pending += 1
+        try:
+            await self._queue.put((tuple(sorted(params.items())), item, cancel, future))
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending -= 1
+
+    async def _collect(self):
+        """取出一个批次：阻塞等待第一个请求，之后在窗口期内继续收集直到批次满"""
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # 上一批推理期间积压的请求直接取出，不再额外等待
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        """后台调度循环"""
+        while True:
+            groups = {}
+            for params, item, cancel, future in await self._collect():
+                # 跳过已被取消的请求（例如客户端已断开）
+                if future.done():
+                    continue
+                if cancel is not None and cancel.cancelled:
+                    future.set_exception(GenerationCancelled(cancel.reason))
+                    continue
+                groups.setdefault(params, []).append((item, cancel, future))
+            for params, batch in groups.items():
+                await self._run_batch(dict(params), batch)
+
+    async def _run_batch(self, params, batch):
+        """在推理执行器中运行一个批次，并把结果分发给各个请求"""
+        items = [item for item, _, _ in batch]
+        cancel_tokens = [cancel for _, cancel, _ in batch]
+        logger.debug(f"批量推理: batch_size={len(items)}, params={params}")
+        try:
+            results = await self.executor.run(self.batch_fn, items, cancel_tokens=cancel_tokens, **params)
+        except Exception as e:
+            logger.error(f"批量推理出错: {e}")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
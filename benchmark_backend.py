@@ -0,0 +1,286 @@
+"""后端压测脚本：按给定并发、提示长度分布和请求比例压测 /generate_code/ 和 /complete_code/，输出 JSON 报告
+
+用法：
+    # 使用随机初始化的微型 CodeGen 模型，在本进程中启动后端后压测
+    python benchmark_backend.py --tiny-model --requests 200 --concurrency 8 --output bench.json
+    # 压测已经运行的后端
+    python benchmark_backend.py --url http://127.0.0.1:8000 --mix generate=1,complete=3,complete_stream=1
+
+报告中的键和取值顺序固定，不同版本的结果可以直接 diff
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from latency_stats import summarize
+
+# 请求类型 -> (路由, 是否流式)
+REQUEST_TYPES = {
+    "generate": ("/generate_code/", False),
+    "complete": ("/complete_code/", False),
+    "generate_stream": ("/generate_code/stream", True),
+    "complete_stream": ("/complete_code/stream", True),
+}
+IDENTIFIER_PATTERN = re.compile(r"\bdef ([A-Za-z_][A-Za-z0-9_]*)\(")
+
+
+def parse_weights(text, cast=str):
+    """解析 "a=1,b=3" 或 "64:3,256:1" 形式的加权列表"""
+    weights = {}
+    for part in text.split(","):
+        if not part.strip():
+            continue
+        key, _, weight = part.replace(":", "=").partition("=")
+        weights[cast(key.strip())] = float(weight) if weight else 1.0
+    return weights
+
+
+def load_corpus(source_dir):
+    """用仓库中的 Python 源码作为补全提示和函数名的来源"""
+    texts = []
+    for path in sorted(glob.glob(os.path.join(source_dir, "*.py"))):
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            texts.append(f.read().replace("\r\n", "\n"))
+    names = sorted(set(IDENTIFIER_PATTERN.findall("\n".join(texts)))) or ["main"]
+    return texts, names
+
+
+def make_prompt(texts, length, rng):
+    """从源码中截取约 length 个字符的补全提示，结束在行尾，让模型从新的一行开始补全"""
+    text = rng.choice(texts)
+    if len(text) <= length:
+        return text
+    start = text.rfind("\n", 0, rng.randrange(0, len(text) - length)) + 1
+    prompt = text[start:start + length]
+    return prompt[:prompt.rfind("\n") + 1] or prompt
+
+
+def build_workload(args):
+    """预先生成全部请求，保证同一个 seed 下每次压测的请求序列相同"""
+    rng = random.Random(args.seed)
+    texts, names = load_corpus(args.corpus)
+    mix = parse_weights(args.mix)
+    unknown = set(mix) - set(REQUEST_TYPES)
+    if unknown:
+        raise ValueError(f"未知的请求类型: {', '.join(sorted(unknown))}")
+    lengths = parse_weights(args.prompt_lengths, int)
+    kinds, kind_weights = list(mix), list(mix.values())
+    length_values, length_weights = list(lengths), list(lengths.values())
+
+    workload = []
+    for _ in range(args.warmup + args.requests):
+        kind = rng.choices(kinds, kind_weights)[0]
+        payload = {"do_sample": not args.greedy}
+        if kind.startswith("generate"):
+            payload["function_name"] = rng.choice(names)
+            prompt_length = len(payload["function_name"])
+        else:
+            prompt_length = rng.choices(length_values, length_weights)[0]
+            payload["prompt"] = make_prompt(texts, prompt_length, rng)
+        if args.model:
+            payload["model"] = args.model
+        workload.append((kind, prompt_length, payload))
+    return workload
+
+
+def send_request(session, base_url, kind, payload, timeout):
+    """发送一个请求，返回 (是否成功, 总耗时, 首个 token 耗时, 响应代码长度)"""
+    path, stream = REQUEST_TYPES[kind]
+    start = time.perf_counter()
+    try:
+        response = session.post(base_url + path, json=payload, timeout=timeout, stream=stream)
+        if response.status_code != 200:
+            response.close()
+            return False, time.perf_counter() - start, None, 0
+        if not stream:
+            data = response.json()
+            code = data.get("generated_code") or data.get("completed_code") or ""
+            return True, time.perf_counter() - start, None, len(code)
+
+        first_token, code, ok = None, "", False
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data: "):
+                continue
+            event = json.loads(line[len("data: "):])
+            if "text" in event and first_token is None:
+                first_token = time.perf_counter() - start
+            if "error" in event:
+                break
+            if event.get("done"):
+                code = event.get("generated_code") or event.get("completed_code") or ""
+                ok = True
+                break
+        response.close()
+        return ok, time.perf_counter() - start, first_token, len(code)
+    except requests.RequestException:
+        return False, time.perf_counter() - start, None, 0
+
+
+def scrape_generated_tokens(base_url):
+    """从 /metrics 读取生成的 token 总数，后端不支持时返回 None"""
+    try:
+        text = requests.get(base_url + "/metrics", timeout=10).text
+    except requests.RequestException:
+        return None
+    total = None
+    for line in text.splitlines():
+        if line.startswith("codegen_generated_tokens_total"):
+            total = (total or 0) + float(line.rsplit(" ", 1)[1])
+    return total
+
+
+def run_benchmark(base_url, workload, args):
+    warmup, measured = workload[:args.warmup], workload[args.warmup:]
+    local = threading.local()
+
+    def worker(item):
+        kind, prompt_length, payload = item
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return (kind, prompt_length) + send_request(local.session, base_url, kind, payload, args.timeout)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(worker, warmup))
+        tokens_before = scrape_generated_tokens(base_url)
+        start = time.perf_counter()
+        results = list(pool.map(worker, measured))
+        elapsed = time.perf_counter() - start
+    tokens_after = scrape_generated_tokens(base_url)
+
+    report = {
+        "config": {
+            "url": base_url,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "mix": parse_weights(args.mix),
+            "prompt_lengths": {str(k): v for k, v in parse_weights(args.prompt_lengths, int).items()},
+            "greedy": args.greedy,
+            "seed": args.seed,
+        },
+        "overall": describe(results, elapsed),
+        "by_type": {},
+        "by_prompt_length": {},
+    }
+    if tokens_before is not None and tokens_after is not None:
+        report["overall"]["tokens_per_second"] = round((tokens_after - tokens_before) / elapsed, 2)
+    for kind in sorted({r[0] for r in results}):
+        report["by_type"][kind] = describe([r for r in results if r[0] == kind], elapsed)
+    for length in sorted({r[1] for r in results if not r[0].startswith("generate")}):
+        subset = [r for r in results if r[1] == length and not r[0].startswith("generate")]
+        report["by_prompt_length"][str(length)] = describe(subset, elapsed)
+    return report
+
+
+def describe(results, elapsed):
+    ok = [r for r in results if r[2]]
+    return {
+        "count": len(results),
+        "errors": len(results) - len(ok),
+        "throughput_rps": round(len(ok) / elapsed, 3) if elapsed > 0 else None,
+        "latency_ms": summarize([r[3] for r in ok]),
+        "ttft_ms": summarize([r[4] for r in ok if r[4] is not None]),
+        "output_chars_per_second": round(sum(r[5] for r in ok) / elapsed, 1) if elapsed > 0 else None,
+    }
+
+
+def build_tiny_model(model_dir, corpus_dir):
+    """训练一个小词表并保存随机初始化的微型 CodeGen 模型，只用于压测服务本身的开销"""
+    if os.path.exists(os.path.join(model_dir, "config.json")):
+        return model_dir
+    from tokenizers import ByteLevelBPETokenizer
+    from transformers import CodeGenConfig, CodeGenForCausalLM, PreTrainedTokenizerFast
+
+    texts, _ = load_corpus(corpus_dir)
+    tokenizer = ByteLevelBPETokenizer()
+    tokenizer.train_from_iterator(texts, vocab_size=1000, min_frequency=1, special_tokens=["<|endoftext|>"])
+    fast_tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer._tokenizer,
+        bos_token="<|endoftext|>",
+        eos_token="<|endoftext|>",
+        unk_token="<|endoftext|>"
+    )
+    config = CodeGenConfig(
+        vocab_size=len(fast_tokenizer),
+        n_positions=2048,
+        n_ctx=2048,
+        n_embd=128,
+        n_layer=2,
+        n_head=4,
+        rotary_dim=16,
+        bos_token_id=fast_tokenizer.eos_token_id,
+        eos_token_id=fast_tokenizer.eos_token_id
+    )
+    model = CodeGenForCausalLM(config)
+    os.makedirs(model_dir, exist_ok=True)
+    model.save_pretrained(model_dir)
+    fast_tokenizer.save_pretrained(model_dir)
+    return model_dir
+
+
+def start_local_server(model_dir):
+    """在本进程中启动后端（结果缓存关闭，避免重复提示直接命中缓存）"""
+    os.environ["CODEGEN_MODEL_PATH"] = model_dir
+    os.environ.setdefault("CODEGEN_CACHE_SIZE", "0")
+    os.environ.setdefault("CODEGEN_PRELOAD", "codegen")
+    import uvicorn
+    import generate_code_backend
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(generate_code_backend.app, host="127.0.0.1", port=port,
+                                           log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    base_url = f"http://127.0.0.1:{port}"
+    # 等待预加载完成，模型加载时间不计入压测
+    while not any(m["loaded"] for m in requests.get(base_url + "/models").json()["models"]):
+        time.sleep(0.1)
+    return base_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CodeGen 后端压测")
+    parser.add_argument("--url", help="已运行的后端地址，不指定时需要 --tiny-model")
+    parser.add_argument("--tiny-model", action="store_true", help="使用随机初始化的微型模型在本进程中启动后端")
+    parser.add_argument("--model-dir", default=os.path.join(".benchmark", "tiny_codegen"), help="微型模型保存目录")
+    parser.add_argument("--model", help="请求中指定的模型名称")
+    parser.add_argument("--requests", type=int, default=100, help="计入统计的请求数")
+    parser.add_argument("--warmup", type=int, default=5, help="预热请求数，不计入统计")
+    parser.add_argument("--concurrency", type=int, default=4, help="并发请求数")
+    parser.add_argument("--mix", default="generate=1,complete=3", help="请求类型及权重，可选 " + ", ".join(REQUEST_TYPES))
+    parser.add_argument("--prompt-lengths", default="64:2,256:2,1024:1", help="补全提示长度（字符）及权重")
+    parser.add_argument("--greedy", action="store_true", help="使用贪心解码（注意后端的结果缓存）")
+    parser.add_argument("--corpus", default=os.path.dirname(os.path.abspath(__file__)), help="提示来源的源码目录")
+    parser.add_argument("--timeout", type=float, default=300, help="单个请求超时时间（秒）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="报告保存路径，默认输出到标准输出")
+    args = parser.parse_args()
+
+    if args.url:
+        base_url = args.url.rstrip("/")
+    elif args.tiny_model:
+        base_url = start_local_server(build_tiny_model(args.model_dir, args.corpus))
+    else:
+        parser.error("需要指定 --url 或 --tiny-model")
+
+    report = run_benchmark(base_url, build_workload(args), args)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import threading
+import time
+
+import torch
+from transformers import StoppingCriteria
+
+
+class GenerationCancelled(Exception):
+    """请求在生成前或生成中被取消（客户端断开、调用取消接口或超过截止时间）"""
+
+    def __init__(self, reason):
+        super().__init__(f"请求已取消: {reason}")
+        self.reason = reason
+
+
+class CancelToken:
+    """单个请求的取消标记（线程安全）：路由协程中设置，推理线程中的停止条件读取
+
+    reason 为 "disconnected"（客户端断开）、"cancelled"（取消接口）或 "deadline"（超过截止时间）
+    """
+
+    def __init__(self, timeout=None):
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        self.reason = None
+        self._lock = threading.Lock()
+
+    def cancel(self, reason="cancelled"):
+        """标记取消，只记录第一次取消的原因"""
+        with self._lock:
+            if self.reason is None:
+                self.reason = reason
+
+    @property
+    def cancelled(self):
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("deadline")
+        return self.reason is not None
+
+    def remaining(self):
+        """距截止时间的秒数，没有截止时间时返回 None"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+
+class CancelCriteria(StoppingCriteria):
+    """请求取消后停止对应的序列；批次中所有序列都停止后 generate 立即返回，推理线程可以处理排队的任务"""
+
+    def __init__(self, tokens):
+        self.tokens = tokens  # 与输入序列一一对应，None 表示该序列不可取消
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = torch.tensor([token is not None and token.cancelled for token in self.tokens], dtype=torch.bool,
+                            device=input_ids.device)
+        if input_ids.shape[0] != done.shape[0]:
+            # 束搜索时每条输入序列连续展开为多行（候选束）
+            done = done.repeat_interleave(input_ids.shape[0] // done.shape[0])
+        return done
+
+
+class ActiveRequests:
+    """按客户端提供的 request_id 登记进行中的请求，取消接口据此找到对应的取消标记"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = {}
+
+    def add(self, request_id, token):
+        with self._lock:
+            previous = self._tokens.get(request_id)
+            self._tokens[request_id] = token
+        # 同一个 request_id 的新请求会取代旧请求
+        if previous is not None:
+            previous.cancel("cancelled")
+
+    def remove(self, request_id, token):
+        with self._lock:
+            if self._tokens.get(request_id) is token:
+                del self._tokens[request_id]
+
+    def cancel(self, request_id, reason="cancelled"):
+        """取消请求，request_id 不存在（未登记或已结束）时返回 False"""
+        with self._lock:
+            token = self._tokens.get(request_id)
+        if token is None:
+            return False
+        token.cancel(reason)
+        return True
+
+    def __len__(self):
+        with self._lock:
+            return len(self._tokens)
@@ -0,0 +1,28 @@
+import ast
+import textwrap
+
+
+def is_valid_python(code):
+    """代码能否被 ast.parse 解析（先去掉公共缩进，类体或函数体中的片段也能检查）"""
+    try:
+        ast.parse(textwrap.dedent(code))
+    except (SyntaxError, ValueError):
+        return False
+    return True
+
+
+def rank_candidates(candidates):
+    """候选排序：能解析的代码优先，其次按平均对数概率从高到低；内容相同的候选只保留一个
+
+    candidates 为 {"code": 代码, "mean_logprob": 平均对数概率} 列表，返回补充了 valid 字段的新列表
+    """
+    scored = [dict(candidate, valid=is_valid_python(candidate["code"])) for candidate in candidates
+              if candidate["code"].strip()]
+    scored.sort(key=lambda candidate: (candidate["valid"], candidate["mean_logprob"]), reverse=True)
+    ranked = []
+    seen = set()
+    for candidate in scored:
+        if candidate["code"] not in seen:
+            seen.add(candidate["code"])
+            ranked.append(candidate)
+    return ranked
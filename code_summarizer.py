@@ -0,0 +1,150 @@
+"""代码摘要：用微调后的 CodeT5 批量生成代码的自然语言描述，后端 /summarize_code/ 接口和离线命令行共用
+
+离线用法（结果逐批写出为 JSON Lines）：
+    python code_summarizer.py --repo <项目目录> --output summaries.jsonl
+    python code_summarizer.py --input codes.jsonl --num-beams 4 > summaries.jsonl
+"""
+import argparse
+import ast
+import itertools
+import json
+import os
+import sys
+import time
+
+import torch
+
+from codet5_constants import SOURCE_PREFIX
+from model_registry import LOAD_MODES, load_model
+
+
+def generate_summary_ids(tokenizer, model, codes, device, max_source_length=256, max_new_tokens=64, num_beams=1,
+                         stopping_criteria=None):
+    """一批代码一次 generate：编码器输入按批内最长序列填充，超长代码截断；num_beams 为 1 时贪心解码，否则束搜索
+
+    返回解码器输出的 token id（每行以解码起始 token 开头）
+    """
+    inputs = tokenizer([SOURCE_PREFIX + code for code in codes], max_length=max_source_length, truncation=True,
+                       padding=True, return_tensors="pt")
+    inputs = {k: v.to(device) for k, v in inputs.items()}
+    with torch.no_grad():
+        return model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            num_beams=num_beams,
+            early_stopping=num_beams > 1,
+            do_sample=False,
+            stopping_criteria=stopping_criteria
+        )
+
+
+def decode_summaries(tokenizer, output_ids):
+    return [text.strip() for text in tokenizer.batch_decode(output_ids, skip_special_tokens=True)]
+
+
+def summarize_batch(tokenizer, model, codes, device, max_source_length=256, max_new_tokens=64, num_beams=1,
+                    stopping_criteria=None):
+    """生成一批代码的摘要文本"""
+    output_ids = generate_summary_ids(tokenizer, model, codes, device, max_source_length, max_new_tokens, num_beams,
+                                      stopping_criteria)
+    return decode_summaries(tokenizer, output_ids)
+
+
+def length_grouped_chunks(items, batch_size, window=50, key=len):
+    """每次读入 batch_size * window 条，按长度排序后切块：块内长度接近，填充少；输入可以是不定长的迭代器"""
+    iterator = iter(items)
+    while True:
+        buffer = list(itertools.islice(iterator, batch_size * window))
+        if not buffer:
+            return
+        buffer.sort(key=key)
+        for start in range(0, len(buffer), batch_size):
+            yield buffer[start:start + batch_size]
+
+
+def _functions(node, path, source, scope=""):
+    for child in ast.iter_child_nodes(node):
+        if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            name = scope + child.name
+            code = ast.get_source_segment(source, child)
+            if code:
+                yield {"path": path, "name": name, "lineno": child.lineno, "code": code}
+            yield from _functions(child, path, source, name + ".")
+        elif isinstance(child, ast.ClassDef):
+            yield from _functions(child, path, source, scope + child.name + ".")
+
+
+def extract_functions(root):
+    """遍历目录下的 .py 文件，逐个取出函数和方法（含嵌套函数）的源码；无法解析的文件跳过"""
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(name for name in dirnames if not name.startswith(".") and name != "__pycache__")
+        for filename in sorted(filenames):
+            if not filename.endswith(".py"):
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    source = f.read()
+                tree = ast.parse(source)
+            except (OSError, UnicodeDecodeError, SyntaxError, ValueError) as e:
+                print(f"跳过 {path}: {e}", file=sys.stderr)
+                continue
+            yield from _functions(tree, os.path.relpath(path, root), source)
+
+
+def read_jsonl(path):
+    """读取 JSON Lines（每行包含 code 字段），path 为 - 时读取标准输入"""
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="用微调后的 CodeT5 批量生成代码摘要，结果按 JSON Lines 逐批输出")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--repo", help="项目目录：为其中所有 Python 函数生成摘要")
+    source.add_argument("--input", help="JSON Lines 输入（每行包含 code 字段，其余字段原样输出），- 表示标准输入")
+    parser.add_argument("--output", default="-", help="JSON Lines 输出文件，默认标准输出")
+    parser.add_argument("--model-path", default=os.environ.get(
+        "CODET5_MODEL_PATH", "D:/PythonCode/CodeBERT/model/finetuned_codet5_small"))
+    parser.add_argument("--load-mode", choices=LOAD_MODES, default="fp32",
+                        help="模型加载模式，与后端的 CODEGEN_LOAD_MODE 相同")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--num-beams", type=int, default=1, help="1 为贪心解码，大于 1 为束搜索")
+    parser.add_argument("--max-source-length", type=int, default=256)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    tokenizer, model, device = load_model(args.model_path, args.load_mode, warmup=False, kind="seq2seq")
+    items = extract_functions(args.repo) if args.repo else read_jsonl(args.input)
+    output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+
+    count = 0
+    start = time.perf_counter()
+    try:
+        for chunk in length_grouped_chunks(items, args.batch_size, key=lambda item: len(item["code"])):
+            summaries = summarize_batch(tokenizer, model, [item["code"] for item in chunk], device,
+                                        args.max_source_length, args.max_new_tokens, args.num_beams)
+            for item, summary in zip(chunk, summaries):
+                record = {key: value for key, value in item.items() if key != "code"}
+                record["summary"] = summary
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()  # 每批写出后立即刷新，下游可以边生成边读取
+            count += len(chunk)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - start
+    print(f"共生成 {count} 条摘要，耗时 {elapsed:.1f} 秒（{count / max(elapsed, 1e-9):.1f} 条/秒）", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
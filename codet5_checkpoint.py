@@ -0,0 +1,123 @@
+"""CodeT5 训练检查点：按步保存 LoRA 适配器、优化器、调度器、梯度缩放和随机数状态，后台线程写盘，支持精确恢复"""
+import os
+import random
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from peft import get_peft_model_state_dict, set_peft_model_state_dict
+
+CHECKPOINT_PATTERN = re.compile(r"^checkpoint-(\d+)$")
+STATE_FILE = "training_state.pt"
+
+
+def to_cpu(obj):
+    """递归复制张量到 CPU：训练继续时原张量会被原地修改，后台写盘必须使用快照"""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [to_cpu(value) for value in obj]
+    if isinstance(obj, tuple):
+        return tuple(to_cpu(value) for value in obj)
+    return obj
+
+
+def rng_state():
+    state = {"python": random.getstate(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def training_state(model, optimizer, scheduler, precision, rng_states, **progress):
+    """恢复训练需要的全部状态；只保存 LoRA 适配器参数，基础模型参数不变
+
+    rng_states 是各进程的随机数状态（按 rank 排列），单进程时只有一个
+    """
+    return {
+        "adapter": get_peft_model_state_dict(model),
+        "optimizer": optimizer.state_dict(),
+        "scheduler": scheduler.state_dict(),
+        "scaler": precision.scaler.state_dict(),
+        "rng": rng_states,
+        "progress": progress
+    }
+
+
+def restore_training_state(state, model, optimizer, scheduler, precision):
+    """载入适配器、优化器、调度器和梯度缩放状态，返回训练进度；随机数状态由调用方在跳过已训练的批次后恢复"""
+    set_peft_model_state_dict(model, state["adapter"])
+    optimizer.load_state_dict(state["optimizer"])
+    scheduler.load_state_dict(state["scheduler"])
+    if state["scaler"]:
+        precision.scaler.load_state_dict(state["scaler"])
+    return state["progress"]
+
+
+def load_checkpoint(path):
+    # 随机数状态中包含 Python 对象，不能只加载权重
+    return torch.load(os.path.join(path, STATE_FILE), map_location="cpu", weights_only=False)
+
+
+class CheckpointManager:
+    """在 directory 下保存 checkpoint-<步数> 目录，只保留最近 keep 个
+
+    save 在调用线程中把状态复制到 CPU，写盘交给后台线程；同一时间最多一个写盘任务，
+    先写入临时目录再重命名，中途崩溃不会留下不完整的检查点
+    """
+
+    def __init__(self, directory, keep=2):
+        self.directory = directory
+        self.keep = keep
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+        self._pending = None
+
+    def save(self, name, state):
+        snapshot = to_cpu(state)
+        self.wait()
+        self._pending = self._executor.submit(self._write, name, snapshot)
+
+    def wait(self):
+        """等待后台写盘完成；写盘失败时在这里抛出异常"""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def _write(self, name, snapshot):
+        path = os.path.join(self.directory, name)
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        torch.save(snapshot, os.path.join(tmp_path, STATE_FILE))
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        self._prune()
+
+    def checkpoints(self):
+        """按步数从小到大排列的 (步数, 路径)"""
+        if not os.path.isdir(self.directory):
+            return []
+        found = []
+        for name in os.listdir(self.directory):
+            match = CHECKPOINT_PATTERN.match(name)
+            if match:
+                found.append((int(match.group(1)), os.path.join(self.directory, name)))
+        return sorted(found)
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1][1] if checkpoints else None
+
+    def _prune(self):
+        for _, path in self.checkpoints()[:-self.keep]:
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,3 @@
+"""CodeT5 训练和推理共用的常量：训练（codet5_data）和摘要服务（code_summarizer）都从这里导入，互不依赖"""
+
+SOURCE_PREFIX = "summarize: "  # 输入代码前的任务前缀，训练和推理必须相同
@@ -0,0 +1,186 @@
+"""CodeT5 微调的数据流水线：流式读取 code_to_text 数据集，迭代到时才分词，每个批次按批内最长序列动态填充
+
+也可以先用多进程把整个数据集分词并缓存为 Arrow 文件（按分词器和最大长度生成指纹），之后的训练直接内存映射加载
+"""
+import itertools
+import os
+import random
+import shutil
+
+from datasets import load_dataset, load_from_disk
+from datasets.fingerprint import Hasher
+from torch.utils.data import IterableDataset
+from transformers import DataCollatorForSeq2Seq
+
+from codet5_constants import SOURCE_PREFIX
+
+TEXT_COLUMNS = ["code", "docstring"]
+PREPROCESS_VERSION = 1  # 分词逻辑变化时加一，使旧缓存失效
+
+
+def load_code_to_text(dataset_name, config_name=None, split="train", data_file=None, streaming=True):
+    """加载数据集：指定 data_file（JSON Lines，包含 code 和 docstring 字段）时读取本地文件，否则从 Hub 读取"""
+    if data_file:
+        return load_dataset("json", data_files={split: data_file}, split=split, streaming=streaming)
+    return load_dataset(dataset_name, config_name, split=split, streaming=streaming)
+
+
+def num_examples(dataset, split="train"):
+    """样本数：优先读取数据集元信息，没有时遍历一遍计数（只读取原始数据，不分词）"""
+    splits = dataset.info.splits
+    if splits and split in splits and splits[split].num_examples:
+        return splits[split].num_examples
+    return sum(1 for _ in dataset)
+
+
+def tokenize_batch(batch, tokenizer, max_source_length, max_target_length):
+    """整批调用分词器，只截断不填充；填充留给 collator 按批处理"""
+    model_inputs = tokenizer([SOURCE_PREFIX + code for code in batch["code"]], max_length=max_source_length,
+                             truncation=True)
+    labels = tokenizer(text_target=batch["docstring"], max_length=max_target_length, truncation=True)
+    model_inputs["labels"] = labels["input_ids"]
+    return model_inputs
+
+
+def tokenized_stream(dataset, tokenizer, max_source_length, max_target_length, shuffle_buffer=0, seed=42):
+    """惰性分词：返回的 IterableDataset 在迭代时才按块分词，不在训练前处理整个数据集
+
+    shuffle_buffer > 0 时在分词前用固定大小的缓冲区打乱原始样本，每个 epoch 调用 set_epoch 换一种顺序
+    """
+    dataset = dataset.select_columns(TEXT_COLUMNS)
+    if shuffle_buffer:
+        dataset = dataset.shuffle(seed=seed, buffer_size=shuffle_buffer)
+    return dataset.map(
+        tokenize_batch,
+        batched=True,
+        remove_columns=TEXT_COLUMNS,
+        fn_kwargs={"tokenizer": tokenizer, "max_source_length": max_source_length,
+                   "max_target_length": max_target_length}
+    )
+
+
+def preprocess_fingerprint(raw_dataset, tokenizer, max_source_length, max_target_length):
+    """缓存指纹：原始数据（含样本选择）、分词器（词表和特殊 token）、最大长度和分词逻辑版本"""
+    return Hasher.hash({
+        "dataset": raw_dataset._fingerprint,
+        "tokenizer": tokenizer,
+        "max_source_length": max_source_length,
+        "max_target_length": max_target_length,
+        "prefix": SOURCE_PREFIX,
+        "version": PREPROCESS_VERSION
+    })
+
+
+def preprocess_cached(raw_dataset, tokenizer, max_source_length, max_target_length, cache_dir, num_proc=None,
+                      batch_size=1000):
+    """多进程分词整个数据集，结果保存在 cache_dir/<指纹> 下；指纹相同的缓存已存在时直接内存映射加载
+
+    返回 (分词后的 Dataset, 是否命中缓存)。先写入临时目录再重命名，中断的预处理不会留下不完整的缓存
+    """
+    fingerprint = preprocess_fingerprint(raw_dataset, tokenizer, max_source_length, max_target_length)
+    path = os.path.join(cache_dir, fingerprint)
+    if os.path.exists(os.path.join(path, "dataset_info.json")):
+        return load_from_disk(path), True
+
+    work_dir = path + ".tmp"
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    if num_proc and num_proc > 1:
+        # 分词器在各子进程中单线程运行，避免进程数 × 线程数超过 CPU 核心数
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    tokenized = raw_dataset.map(
+        tokenize_batch,
+        batched=True,
+        batch_size=batch_size,
+        num_proc=num_proc if num_proc and num_proc > 1 else None,
+        remove_columns=raw_dataset.column_names,
+        fn_kwargs={"tokenizer": tokenizer, "max_source_length": max_source_length,
+                   "max_target_length": max_target_length},
+        cache_file_name=os.path.join(work_dir, "map", "tokenized.arrow"),
+        new_fingerprint=fingerprint,
+        desc="分词"
+    )
+    tokenized.save_to_disk(os.path.join(work_dir, "dataset"))
+    del tokenized
+    os.replace(os.path.join(work_dir, "dataset"), path)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return load_from_disk(path), False
+
+
+def cached_stream(tokenized, shuffle_buffer=0, seed=42, num_shards=64):
+    """把缓存的 Dataset 转成与流式流水线相同的 IterableDataset：打乱分片顺序，再用缓冲区打乱样本"""
+    dataset = tokenized.to_iterable_dataset(num_shards=max(1, min(num_shards, len(tokenized))))
+    if shuffle_buffer:
+        dataset = dataset.shuffle(seed=seed, buffer_size=shuffle_buffer)
+    return dataset
+
+
+def build_collator(tokenizer, pad_to_multiple_of=None):
+    """按批内最长序列动态填充；标签的填充位置设为 -100，不参与损失计算"""
+    return DataCollatorForSeq2Seq(
+        tokenizer,
+        padding="longest",
+        label_pad_token_id=-100,
+        pad_to_multiple_of=pad_to_multiple_of,
+        return_tensors="pt"
+    )
+
+
+def example_length(example):
+    """排序用的样本长度：先按输入长度，再按标签长度"""
+    return len(example["input_ids"]), len(example["labels"])
+
+
+def length_grouped_batches(examples, batch_size, bucket_size, rng):
+    """按长度分组成批次：每次读入 batch_size * bucket_size 条样本，按长度排序后切成批次，再打乱这些批次的顺序
+
+    同一批次内的样本长度接近，动态填充时几乎没有填充；批次之间仍是随机顺序
+    """
+    iterator = iter(examples)
+    while True:
+        bucket = list(itertools.islice(iterator, batch_size * bucket_size))
+        if not bucket:
+            return
+        bucket.sort(key=example_length)
+        batches = [bucket[start:start + batch_size] for start in range(0, len(bucket), batch_size)]
+        rng.shuffle(batches)
+        yield from batches
+
+
+class TrainingBatches(IterableDataset):
+    """训练批次流：在分词后的样本流上按需按长度分组，产出样本列表
+
+    配合 DataLoader(batch_size=None, collate_fn=collator) 使用；不分组时与按顺序切分批次相同。
+    不把多条样本拼接成一条：T5 的编码器、解码器和交叉注意力都会跨样本相互注意，改变训练目标
+    """
+
+    def __init__(self, dataset, batch_size, group_by_length=False, bucket_size=50, seed=42):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.group_by_length = group_by_length
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.dataset.set_epoch(epoch)
+
+    def __iter__(self):
+        examples = iter(self.dataset)
+        if self.group_by_length:
+            yield from length_grouped_batches(examples, self.batch_size, self.bucket_size,
+                                              random.Random(self.seed + self.epoch))
+            return
+        while True:
+            batch = list(itertools.islice(examples, self.batch_size))
+            if not batch:
+                return
+            yield batch
+
+
+def padding_counts(batch):
+    """批次中的有效 token 数和填充后的总 token 数（输入和标签合计）"""
+    labels = batch["labels"]
+    real = int(batch["attention_mask"].sum()) + int((labels != -100).sum())
+    return real, batch["attention_mask"].numel() + labels.numel()
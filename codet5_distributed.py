@@ -0,0 +1,110 @@
+"""多进程数据并行训练（用 torchrun 启动）：初始化进程组、按进程切分数据、各进程同步结束 epoch、跨进程汇总统计
+
+单进程运行时所有函数退化为普通的单机逻辑
+"""
+import contextlib
+import os
+
+import torch
+import torch.distributed as dist
+from datasets.distributed import split_dataset_by_node
+
+
+class DistributedContext:
+    """torchrun 通过环境变量传入的进程信息"""
+
+    def __init__(self):
+        self.rank = int(os.environ.get("RANK", 0))
+        self.world_size = int(os.environ.get("WORLD_SIZE", 1))
+        self.local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        self.local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+        self.device = None
+
+    @property
+    def enabled(self):
+        return self.world_size > 1
+
+    @property
+    def is_main(self):
+        """只有主进程（rank 0）打印日志和保存文件"""
+        return self.rank == 0
+
+    def setup(self, backend=None):
+        """选择设备并初始化进程组：CUDA 上每个进程使用一张卡（nccl），CPU 上使用 gloo"""
+        if torch.cuda.is_available():
+            self.device = torch.device("cuda", self.local_rank)
+            torch.cuda.set_device(self.device)
+        else:
+            self.device = torch.device("cpu")
+        if self.enabled and not dist.is_initialized():
+            dist.init_process_group(backend=backend or ("nccl" if self.device.type == "cuda" else "gloo"))
+        return self.device
+
+    def default_num_threads(self):
+        """每个进程的计算线程数：本机 CPU 核心平均分给各进程（torchrun 默认把 OMP_NUM_THREADS 设为 1）"""
+        if not self.enabled:
+            return None
+        return max(1, (os.cpu_count() or 1) // self.local_world_size)
+
+    @contextlib.contextmanager
+    def main_process_first(self):
+        """主进程先执行（例如写预处理缓存），其他进程等它完成后再执行（直接读取缓存）"""
+        if not self.is_main:
+            self.barrier()
+        yield
+        if self.is_main:
+            self.barrier()
+
+    def shard(self, dataset):
+        """每个进程只读取自己的分片：分片数能被进程数整除时按分片分配，否则各进程按样本轮流取"""
+        if not self.enabled:
+            return dataset
+        return split_dataset_by_node(dataset, rank=self.rank, world_size=self.world_size)
+
+    def lockstep(self, batches):
+        """按长度分组和打包会让各进程的批次数略有不同；任一进程取完后所有进程一起结束本 epoch，
+        否则多出来的批次在梯度同步时会一直等待其他进程
+        """
+        if not self.enabled:
+            yield from batches
+            return
+        iterator = iter(batches)
+        while True:
+            batch = next(iterator, None)
+            has_batch = torch.tensor([0 if batch is None else 1], device=self.device)
+            dist.all_reduce(has_batch, op=dist.ReduceOp.MIN)
+            if not has_batch.item():
+                return
+            yield batch
+
+    def all_reduce_sum(self, values):
+        """对各进程的计数求和"""
+        if not self.enabled:
+            return list(values)
+        tensor = torch.tensor(values, dtype=torch.float64, device=self.device)
+        dist.all_reduce(tensor)
+        return tensor.tolist()
+
+    def average_gradients(self, parameters):
+        """手动对各进程的梯度取平均（在 no_sync 中累积、DDP 没有同步的梯度）"""
+        if not self.enabled:
+            return
+        for p in parameters:
+            if p.grad is not None:
+                dist.all_reduce(p.grad)
+                p.grad.div_(self.world_size)
+
+    def all_gather_object(self, obj):
+        if not self.enabled:
+            return [obj]
+        gathered = [None] * self.world_size
+        dist.all_gather_object(gathered, obj)
+        return gathered
+
+    def barrier(self):
+        if self.enabled:
+            dist.barrier()
+
+    def cleanup(self):
+        if self.enabled and dist.is_initialized():
+            dist.destroy_process_group()
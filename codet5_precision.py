@@ -0,0 +1,65 @@
+"""训练精度设置：按设备选择混合精度（CPU 用 bf16，CUDA 用 fp16/bf16），只在 fp16 时启用梯度缩放"""
+import contextlib
+
+import torch
+
+from cpu_features import cpu_supports_bf16
+
+PRECISIONS = ("auto", "fp32", "fp16", "bf16")
+DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def resolve_precision(device, precision="auto"):
+    """auto：CUDA 支持 bf16 时用 bf16（不需要梯度缩放），否则 fp16；CPU 有原生 bf16 指令（AVX512-BF16 / AMX）时用 bf16，
+    否则 fp32（没有原生指令时 bf16 autocast 反而比 fp32 慢）
+    """
+    if precision != "auto":
+        if precision == "fp16" and device.type != "cuda":
+            raise ValueError("fp16 混合精度只支持 CUDA，CPU 请使用 bf16 或 fp32")
+        return precision
+    if device.type == "cuda":
+        return "bf16" if torch.cuda.is_bf16_supported() else "fp16"
+    return "bf16" if cpu_supports_bf16() else "fp32"
+
+
+class PrecisionEngine:
+    """封装 autocast 和 GradScaler：fp32 时 autocast 为空操作，非 fp16 时 GradScaler 被禁用（scale/step/update 直接透传）"""
+
+    def __init__(self, device, precision="auto"):
+        self.device = device
+        self.precision = resolve_precision(device, precision)
+        self.dtype = DTYPES.get(self.precision)
+        self.scaler = torch.amp.GradScaler(device.type, enabled=self.precision == "fp16")
+
+    def autocast(self):
+        if self.dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.dtype)
+
+    def backward(self, loss):
+        self.scaler.scale(loss).backward()
+
+    def unscale(self, optimizer):
+        """梯度裁剪前先还原梯度的缩放"""
+        self.scaler.unscale_(optimizer)
+
+    def step(self, optimizer):
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+
+def configure_threads(num_threads=None, num_interop_threads=None):
+    """设置 PyTorch 的计算线程数和算子间线程数（CPU 训练时按物理核心数设置通常最快）"""
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        # 只能在第一次并行计算之前设置
+        torch.set_num_interop_threads(num_interop_threads)
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+
+def maybe_compile(model, enabled=False, mode=None):
+    """可选的 torch.compile；输入长度随批次变化，使用 dynamic=True 避免每种长度重新编译"""
+    if not enabled:
+        return model
+    return torch.compile(model, mode=mode, dynamic=True)
@@ -0,0 +1,11 @@
+"""CPU 特性检测：推理（model_registry）和训练（codet5_precision）共用，不依赖任何一方的模块"""
+
+
+def cpu_supports_bf16():
+    """检查 CPU 是否有原生 bf16 指令"""
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
@@ -0,0 +1,147 @@
+import threading
+from collections import OrderedDict
+
+import torch
+
+# 自检用的代码样本：覆盖缩进、空行、注释和中文
+_SAMPLE = "import os\n\n# 生成一个名为 main 的 Python 函数。\ndef main(argv):\n    x = [1, 2]\n\n\treturn x\nclass A:\n    pass\nprint(main(1))\n"
+
+
+def safe_boundaries(text):
+    """可以安全切分编码的位置：换行符之后，且换行符前后都不是空白字符
+
+    字节级 BPE 的预分词会把连续的空白合并成一段，除此之外不会跨越换行，两段分别编码再拼接与整体编码结果相同
+    """
+    positions = []
+    start = 0
+    while True:
+        index = text.find("\n", start)
+        if index == -1 or index + 1 >= len(text):
+            return positions
+        if index > 0 and not text[index - 1].isspace() and not text[index + 1].isspace():
+            positions.append(index + 1)
+        start = index + 1
+
+
+def supports_boundary_reuse(tokenizer):
+    """用样本检查该分词器在安全位置切分编码后是否与整体编码一致（SentencePiece 等分词器通常不满足）"""
+    full = tokenizer.encode(_SAMPLE, add_special_tokens=False)
+    for position in safe_boundaries(_SAMPLE):
+        left = tokenizer.encode(_SAMPLE[:position], add_special_tokens=False)
+        right = tokenizer.encode(_SAMPLE[position:], add_special_tokens=False)
+        if left + right != full:
+            return False
+    return True
+
+
+class EncodingCache:
+    """提示编码缓存：相同提示直接复用编码结果；提示以缓存过的内容开头时只编码新增部分
+
+    编辑器中连续补全时，新提示通常是上一次提示加上几行代码，只需编码最后一个安全切分位置之后的文本
+    """
+
+    def __init__(self, tokenizer, max_entries=1024, max_boundaries=8):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.max_boundaries = max_boundaries  # 查找可复用前缀时最多向前检查的切分位置数
+        # 切分位置对应的 token 数需要快速分词器提供的 offset_mapping
+        self.reuse_prefix = tokenizer.is_fast and supports_boundary_reuse(tokenizer)
+        # 分词器在编码结果前后添加的特殊 token（如 BOS / EOS）
+        bare = tokenizer.encode(_SAMPLE, add_special_tokens=False)
+        full = tokenizer.encode(_SAMPLE)
+        start = next(i for i in range(len(full) - len(bare) + 1) if full[i:i + len(bare)] == bare)
+        self._special_prefix = full[:start]
+        self._special_suffix = full[start + len(bare):]
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # 文本 -> token id 元组（不含特殊 token）
+        self._lock = threading.Lock()
+
+    def encode(self, text):
+        """返回 text 的 token id 列表（已按分词器规则添加特殊 token）"""
+        return self._special_prefix + list(self._encode(text)) + self._special_suffix
+
+    def _encode(self, text):
+        with self._lock:
+            ids = self._entries.get(text)
+            if ids is not None:
+                self._entries.move_to_end(text)
+                self.hits += 1
+                return ids
+            prefix, prefix_ids = self._find_prefix(text)
+
+        suffix_ids, ends = self._tokenize(text[len(prefix):], len(prefix))
+        ids = (prefix_ids or ()) + suffix_ids
+
+        with self._lock:
+            if prefix_ids is not None:
+                self.prefix_hits += 1
+            else:
+                self.misses += 1
+            self._put(text, ids)
+            # 同时缓存最后一个安全切分位置之前的部分，供下一次以它开头的提示复用
+            boundaries = safe_boundaries(text) if self.reuse_prefix else []
+            if boundaries and boundaries[-1] > len(prefix):
+                count = sum(1 for end in ends if end <= boundaries[-1])
+                self._put(text[:boundaries[-1]], (prefix_ids or ()) + suffix_ids[:count])
+        return ids
+
+    def _tokenize(self, text, offset):
+        """编码 text，返回 (token id 元组, 每个 token 在完整提示中的结束位置)"""
+        if not self.reuse_prefix:
+            return tuple(self.tokenizer.encode(text, add_special_tokens=False)), []
+        encoding = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        return tuple(encoding["input_ids"]), [offset + end for _, end in encoding["offset_mapping"]]
+
+    def _find_prefix(self, text):
+        if not self.reuse_prefix:
+            return "", None
+        for position in reversed(safe_boundaries(text)[-self.max_boundaries:]):
+            ids = self._entries.get(text[:position])
+            if ids is not None:
+                self._entries.move_to_end(text[:position])
+                return text[:position], ids
+        return "", None
+
+    def _put(self, text, ids):
+        self._entries[text] = ids
+        self._entries.move_to_end(text)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def batch(self, prompts, device, max_tokens=None):
+        """编码一批提示并按分词器的 padding_side 填充，返回 generate 所需的 input_ids 和 attention_mask
+
+        指定 max_tokens 时超长的提示从左侧截断，只保留最后 max_tokens 个 token（离光标最近的上下文）
+        """
+        encoded = [self.encode(prompt) for prompt in prompts]
+        if max_tokens is not None:
+            encoded = [ids[-max_tokens:] for ids in encoded]
+        length = max(len(ids) for ids in encoded)
+        pad_id = self.tokenizer.pad_token_id
+        input_ids, attention_mask = [], []
+        for ids in encoded:
+            padding = length - len(ids)
+            if self.tokenizer.padding_side == "left":
+                input_ids.append([pad_id] * padding + ids)
+                attention_mask.append([0] * padding + [1] * len(ids))
+            else:
+                input_ids.append(ids + [pad_id] * padding)
+                attention_mask.append([1] * len(ids) + [0] * padding)
+        return {
+            "input_ids": torch.tensor(input_ids, dtype=torch.long, device=device),
+            "attention_mask": torch.tensor(attention_mask, dtype=torch.long, device=device)
+        }
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.prefix_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "prefix_hits": self.prefix_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.prefix_hits) / total if total else 0.0,
+                "reuse_prefix": self.reuse_prefix
+            }
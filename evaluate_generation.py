@@ -0,0 +1,315 @@
+"""离线评测：用 eval_data 中固定的提示集评测生成质量和速度，输出 JSON 报告
+
+评测项目：
+    generate   按函数名生成函数（generate_function_code_batch），统计可解析率
+    complete   补全代码片段（complete_code_batch），统计可解析率
+    humaneval  补全 HumanEval 格式的题目并运行附带的单元测试，统计 pass@k
+    summarize  CodeT5 代码摘要，统计与参考摘要的 BLEU-4
+每项同时统计延迟（毫秒）和生成速度（tokens/s）。模型由与后端相同的环境变量配置（CODEGEN_MODEL_PATH、CODEGEN_LOAD_MODE、
+CODEGEN_DRAFT_MODEL_PATH 等），生成时调用与后端相同的函数，因此可以对比开启某项加速前后的质量：
+
+    python evaluate_generation.py --output base.json
+    CODEGEN_DRAFT_MODEL_PATH=/models/draft python evaluate_generation.py --baseline base.json
+
+指定 --baseline 时，任一质量指标比基线下降超过 --tolerance 则以退出码 1 结束。
+注意：humaneval 会在子进程中执行模型生成的代码，只应在可信的环境中运行
+"""
+import argparse
+import collections
+import json
+import math
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from candidate_ranking import is_valid_python
+from latency_stats import summarize
+
+TASKS = ("generate", "complete", "humaneval", "summarize")
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "eval_data")
+BLEU_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+# 质量指标：报告中 (评测项, 键)，数值越大越好
+QUALITY_METRICS = (
+    ("generate", "valid_rate"),
+    ("complete", "valid_rate"),
+    ("humaneval", "valid_rate"),
+    ("humaneval", "pass@*"),
+    ("summarize", "bleu"),
+)
+
+
+def read_jsonl(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_suite(data_dir):
+    with open(os.path.join(data_dir, "prompts.json"), encoding="utf-8") as f:
+        prompts = json.load(f)
+    return {
+        "function_names": prompts["function_names"],
+        "completion_prompts": prompts["completion_prompts"],
+        "problems": read_jsonl(os.path.join(data_dir, "humaneval_local.jsonl")),
+        "summaries": read_jsonl(os.path.join(data_dir, "summaries.jsonl")),
+    }
+
+
+def pass_at_k(n, c, k):
+    """无偏估计：n 个样本中有 c 个通过时，随机取 k 个至少一个通过的概率"""
+    if n - c < k:
+        return 1.0
+    return 1.0 - math.prod(1.0 - k / i for i in range(n - c + 1, n + 1))
+
+
+def _ngrams(tokens, n):
+    return collections.Counter(tuple(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+
+
+def sentence_bleu(reference, hypothesis, max_n=4):
+    """平滑的句子级 BLEU-4（1 阶以上的 n-gram 精确率加一平滑，代码摘要评测的常用做法），取值 0~1"""
+    ref = BLEU_TOKEN_PATTERN.findall(reference.lower())
+    hyp = BLEU_TOKEN_PATTERN.findall(hypothesis.lower())
+    if not hyp or not ref:
+        return 0.0
+    log_precision = 0.0
+    for n in range(1, max_n + 1):
+        hyp_ngrams = _ngrams(hyp, n)
+        matches = sum((hyp_ngrams & _ngrams(ref, n)).values())
+        total = max(len(hyp) - n + 1, 0)
+        if n == 1:
+            if matches == 0:
+                return 0.0
+            log_precision += math.log(matches / total)
+        else:
+            log_precision += math.log((matches + 1) / (total + 1))
+    brevity_penalty = min(0.0, 1 - len(ref) / len(hyp))
+    return math.exp(brevity_penalty + log_precision / max_n)
+
+
+def run_tests(problem, completion, timeout):
+    """在独立的子进程中运行题目附带的单元测试，返回是否通过"""
+    program = f"{completion}\n\n{problem['test']}\n\ncheck({problem['entry_point']})\n"
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "program.py")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(program)
+        try:
+            result = subprocess.run([sys.executable, "-I", path], cwd=workdir, timeout=timeout,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except subprocess.TimeoutExpired:
+            return False
+    return result.returncode == 0
+
+
+def chunks(items, batch_size):
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def run_task(generate, inputs, batch_size, tokenizer, seed):
+    """按批调用 generate(inputs) -> [(完整输出, 新生成的文本)]
+
+    批内每条结果的延迟记为整批耗时；速度按新生成文本重新分词后的 token 数计算（不含已停止序列的填充）
+    """
+    torch.manual_seed(seed)
+    outputs, latencies = [], []
+    generated_tokens, elapsed = 0, 0.0
+    for batch in chunks(inputs, batch_size):
+        start = time.perf_counter()
+        results = generate(batch)
+        seconds = time.perf_counter() - start
+        elapsed += seconds
+        latencies.extend([seconds] * len(batch))
+        for output, new_text in results:
+            outputs.append(output)
+            generated_tokens += len(tokenizer(new_text, add_special_tokens=False)["input_ids"])
+    return outputs, {
+        "count": len(inputs),
+        "latency_ms": summarize(latencies),
+        "tokens_per_second": round(generated_tokens / elapsed, 2) if elapsed > 0 else None,
+    }
+
+
+def validity(outputs):
+    return {
+        "valid_rate": round(sum(is_valid_python(code) for code in outputs) / len(outputs), 4),
+        "empty_rate": round(sum(not code.strip() for code in outputs) / len(outputs), 4),
+    }
+
+
+def evaluate_generate(backend, loaded, names, args):
+    def generate(batch):
+        results = backend.generate_function_code_batch(
+            batch, loaded.tokenizer, loaded.model, loaded.device, max_new_tokens=args.max_new_tokens,
+            do_sample=args.sample, prefix_cache=loaded.prefix_cache, draft=loaded.draft,
+            encoding_cache=loaded.encoding_cache
+        )
+        return [(code, code[len(f"def {name}("):]) for name, code in zip(batch, results)]
+
+    outputs, report = run_task(generate, names, args.batch_size, loaded.tokenizer, args.seed)
+    report.update(validity(outputs))
+    return report
+
+
+def complete_fn(backend, loaded, do_sample, args):
+    def complete(batch):
+        results = backend.complete_code_batch(
+            loaded.tokenizer, loaded.model, batch, loaded.device, max_length=args.max_length, do_sample=do_sample,
+            prefix_cache=loaded.prefix_cache, draft=loaded.draft, encoding_cache=loaded.encoding_cache
+        )
+        return [(code, code[len(prompt):]) for prompt, code in zip(batch, results)]
+    return complete
+
+
+def evaluate_complete(backend, loaded, prompts, args):
+    outputs, report = run_task(complete_fn(backend, loaded, args.sample, args), prompts, args.batch_size,
+                               loaded.tokenizer, args.seed)
+    report.update(validity(outputs))
+    return report
+
+
+def evaluate_humaneval(backend, loaded, problems, args):
+    """每道题生成 num_samples 个补全（多于 1 个时使用采样），逐个运行单元测试"""
+    do_sample = args.sample or args.num_samples > 1
+    items = [problem for problem in problems for _ in range(args.num_samples)]
+    outputs, report = run_task(complete_fn(backend, loaded, do_sample, args), [p["prompt"] for p in items],
+                               args.batch_size, loaded.tokenizer, args.seed)
+    with ThreadPoolExecutor(max_workers=args.test_workers) as pool:
+        passed = list(pool.map(lambda pair: run_tests(pair[0], pair[1], args.test_timeout), zip(items, outputs)))
+
+    correct = collections.Counter(problem["task_id"] for problem, ok in zip(items, passed) if ok)
+    report["problems"] = len(problems)
+    report["num_samples"] = args.num_samples
+    report.update(validity(outputs))
+    for k in args.k:
+        if k <= args.num_samples:
+            scores = [pass_at_k(args.num_samples, correct[problem["task_id"]], k) for problem in problems]
+            report[f"pass@{k}"] = round(sum(scores) / len(scores), 4)
+    report["passed"] = sorted(correct)
+    return report
+
+
+def evaluate_summarize(backend, loaded, pairs, args):
+    def summarize_codes(batch):
+        summaries = backend.summarize_code_batch(loaded.tokenizer, loaded.model, batch, loaded.device,
+                                                 num_beams=args.num_beams, max_new_tokens=args.max_summary_tokens)
+        return [(summary, summary) for summary in summaries]
+
+    outputs, report = run_task(summarize_codes, [pair["code"] for pair in pairs], args.batch_size, loaded.tokenizer,
+                               args.seed)
+    scores = [sentence_bleu(pair["summary"], output) for pair, output in zip(pairs, outputs)]
+    report["bleu"] = round(sum(scores) / len(scores) * 100, 2)
+    report["num_beams"] = args.num_beams
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """对比基线报告中的质量指标，返回下降超过容差的 [(指标, 基线值, 当前值)]
+
+    valid_rate 和 pass@k 为 0~1 的比例，按绝对值比较；BLEU 为 0~100，容差乘以 100
+    """
+    regressions = []
+    for task, key in QUALITY_METRICS:
+        current, previous = report.get(task) or {}, baseline.get(task) or {}
+        keys = [name for name in current if name.startswith("pass@")] if key == "pass@*" else [key]
+        for name in keys:
+            if name not in current or name not in previous:
+                continue
+            allowed = tolerance * 100 if name == "bleu" else tolerance
+            if current[name] < previous[name] - allowed:
+                regressions.append((f"{task}.{name}", previous[name], current[name]))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="离线评测代码生成、补全和摘要的质量与速度")
+    parser.add_argument("--tasks", default=",".join(TASKS), help="评测项目，可选 " + ", ".join(TASKS))
+    parser.add_argument("--model", help="代码生成/补全模型名称，默认使用注册表的默认模型")
+    parser.add_argument("--summarize-model", default=os.environ.get("CODEGEN_SUMMARIZE_MODEL", "codet5"),
+                        help="代码摘要模型名称")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="评测数据目录")
+    parser.add_argument("--batch-size", type=int, default=1, help="每次 generate 的提示数；1 时延迟即单个请求的延迟")
+    parser.add_argument("--sample", action="store_true", help="使用采样解码（默认贪心解码，结果可复现）")
+    parser.add_argument("--max-new-tokens", type=int, default=200, help="函数生成的最大新 token 数")
+    parser.add_argument("--max-length", type=int, default=300, help="补全的最大总长度（提示 + 生成），与后端相同")
+    parser.add_argument("--num-samples", type=int, default=1, help="humaneval 每题的样本数，大于 1 时使用采样")
+    parser.add_argument("--k", default="1,10", help="humaneval 计算的 pass@k（k 不大于样本数时才计算）")
+    parser.add_argument("--test-timeout", type=float, default=10, help="单个单元测试的超时时间（秒）")
+    parser.add_argument("--test-workers", type=int, default=os.cpu_count() or 1, help="并行运行单元测试的进程数")
+    parser.add_argument("--num-beams", type=int, default=1, help="摘要的束搜索宽度")
+    parser.add_argument("--max-summary-tokens", type=int, default=64, help="摘要的最大新 token 数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="报告保存路径，默认输出到标准输出")
+    parser.add_argument("--baseline", help="基线报告：质量指标下降超过容差时以退出码 1 结束")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="允许的质量下降（比例，BLEU 按百分点）")
+    args = parser.parse_args()
+    args.tasks = [task.strip() for task in args.tasks.split(",") if task.strip()]
+    unknown = set(args.tasks) - set(TASKS)
+    if unknown:
+        parser.error(f"未知的评测项目: {', '.join(sorted(unknown))}")
+    args.k = sorted({int(k) for k in args.k.split(",") if k.strip()})
+    if args.batch_size < 1 or args.num_samples < 1:
+        parser.error("--batch-size 和 --num-samples 必须大于 0")
+    return args
+
+
+def main():
+    args = parse_args()
+    # 与后端共用生成函数和模型注册表（由环境变量配置）；直接调用生成函数，不经过结果缓存
+    import generate_code_backend as backend
+
+    registry = backend.registry
+    suite = load_suite(args.data_dir)
+    report = {"config": {
+        "tasks": args.tasks,
+        "batch_size": args.batch_size,
+        "sample": args.sample,
+        "seed": args.seed,
+        "models": {},
+    }}
+
+    causal_tasks = [task for task in args.tasks if task != "summarize"]
+    if causal_tasks:
+        model_name = registry.resolve(args.model)
+        if registry.specs[model_name].kind != "causal":
+            raise SystemExit(f"模型 {model_name} 不是代码生成模型")
+        # 加载（和预热）不计入耗时
+        loaded = registry.get(model_name)
+        report["config"]["models"][model_name] = registry.specs[model_name].to_dict()
+        if "generate" in args.tasks:
+            report["generate"] = evaluate_generate(backend, loaded, suite["function_names"], args)
+        if "complete" in args.tasks:
+            report["complete"] = evaluate_complete(backend, loaded, suite["completion_prompts"], args)
+        if "humaneval" in args.tasks:
+            report["humaneval"] = evaluate_humaneval(backend, loaded, suite["problems"], args)
+    if "summarize" in args.tasks:
+        model_name = registry.resolve(args.summarize_model)
+        if registry.specs[model_name].kind != "seq2seq":
+            raise SystemExit(f"模型 {model_name} 不是代码摘要模型")
+        loaded = registry.get(model_name)
+        report["config"]["models"][model_name] = registry.specs[model_name].to_dict()
+        report["summarize"] = evaluate_summarize(backend, loaded, suite["summaries"], args)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for name, previous, current in regressions:
+            print(f"质量下降: {name} {previous} -> {current}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,152 +1,1173 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
 from pydantic import BaseModel
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import TextIteratorStreamer, StoppingCriteriaList
+from typing import List, Optional
 import torch
+import asyncio
+import atexit
+import contextlib
+import json
 import os
 import logging
+import time
 
-# 设置日志
-logging.basicConfig(level=logging.DEBUG)
+from batch_scheduler import BatchScheduler
+from cancellation import ActiveRequests, CancelCriteria, CancelToken, GenerationCancelled
+from candidate_ranking import rank_candidates
+from code_summarizer import decode_summaries, generate_summary_ids
+from inference_executor import InferenceExecutor, QueueFullError
+from metrics import BATCH_SIZE_BUCKETS, GenerationTimer, MetricsRegistry, count_generated_tokens
+from model_registry import ModelRegistry, process_memory_mb, resident_memory_mb
+from prefix_cache import cache_length, repeat_cache
+from result_cache import ResultCache
+from stopping_criteria import (CodeStoppingCriteria, COMPLETION_STOP_RULES, FUNCTION_STOP_RULES, RowBudgetCriteria,
+                               find_stop, safe_length, stop_stats)
+
+# 设置日志（DEBUG 级别会在每个请求上输出日志，生产环境默认使用 INFO）
+logging.basicConfig(level=os.environ.get("CODEGEN_LOG_LEVEL", "INFO"))
 logger = logging.getLogger(__name__)
 
 # 初始化 FastAPI 应用
 app = FastAPI()
 
 
-# 模型加载函数
-def load_model(model_path):
-    if not os.path.exists(model_path):
-        raise FileNotFoundError(f"模型路径未找到: {model_path}")
-
-    logger.debug(f"加载模型路径: {model_path}")
-    tokenizer = AutoTokenizer.from_pretrained(model_path)
-    model = AutoModelForCausalLM.from_pretrained(model_path)
-
-    if tokenizer.pad_token is None:
-        tokenizer.pad_token = tokenizer.eos_token
-        model.config.pad_token_id = tokenizer.eos_token_id
+# 模型注册表：启动时不加载模型，首次请求时在推理线程中加载
+registry = ModelRegistry.from_env()
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model.to(device)
+# 指标：/metrics 按 Prometheus 文本格式导出；队列、缓存和内存等状态在导出时读取，不占用请求路径
+metrics = MetricsRegistry()
+stage_seconds = metrics.histogram("codegen_stage_seconds", "各阶段耗时（秒），按 stage 和 task 区分")
+request_seconds = metrics.histogram("codegen_request_seconds", "HTTP 请求耗时（秒），流式请求只计到开始响应")
+batch_sizes = metrics.histogram("codegen_batch_size", "每次 generate 的序列数", buckets=BATCH_SIZE_BUCKETS)
+generated_tokens = metrics.counter("codegen_generated_tokens_total", "生成的 token 总数")
+decode_speed = metrics.gauge("codegen_decode_tokens_per_second", "最近一次生成的解码速度（tokens/s）")
+cancelled_requests = metrics.counter("codegen_cancelled_requests_total", "被取消的请求数，按原因区分")
 
-    return tokenizer, model, device
 
-
-# 加载模型
-model_path = r"D:\PythonCode\CodeBERT\model\codegen"
-tokenizer, model, device = load_model(model_path)
+def record_generation(timer, task, batch_size, generated=None):
+    """generate 结束后记录 prefill / decode 耗时、token 数和解码速度；generated 为各行实际生成的 token 总数"""
+    speed = timer.record(stage_seconds, generated_tokens, batch_size, generated, task=task)
+    if speed:
+        decode_speed.set(speed, task=task)
 
 
 # 定义请求数据模型
 class FunctionRequest(BaseModel):
     function_name: str
+    do_sample: bool = True  # False 时使用贪心解码，结果确定，可直接复用缓存
+    reuse_sampled: bool = False  # 采样模式下是否允许复用之前的采样结果
+    model: Optional[str] = None  # 模型名称，默认使用注册表中的默认模型
+    num_candidates: int = 1  # 大于 1 时返回排序后的多个候选（需要采样模式，不使用结果缓存）
+    request_id: Optional[str] = None  # 客户端生成的请求标识，用于 POST /cancel/{request_id}
+    timeout: Optional[float] = None  # 请求截止时间（秒），也可以通过 X-Request-Timeout 请求头指定
+
+
+class FunctionBatchRequest(BaseModel):
+    function_names: List[str]
+    num_return_sequences: int = 1  # 每个函数名生成的候选数，大于 1 时需要采样模式
+    do_sample: bool = True
+    model: Optional[str] = None
+    request_id: Optional[str] = None
+    timeout: Optional[float] = None
 
 
 class CodeCompletionRequest(BaseModel):
     prompt: str
+    do_sample: bool = True
+    reuse_sampled: bool = False
+    model: Optional[str] = None
+    num_candidates: int = 1
+    request_id: Optional[str] = None
+    timeout: Optional[float] = None
 
 
-# 生成函数代码的函数
-def generate_function_code(function_name, tokenizer, model, device, max_new_tokens=200):
-    prompt = f"# 生成一个名为 {function_name} 的 Python 函数。\n\ndef {function_name}("
-    input_ids = tokenizer.encode(prompt, return_tensors="pt").to(device)
+class SummarizeRequest(BaseModel):
+    codes: List[str]
+    num_beams: int = 1  # 1 为贪心解码，大于 1 为束搜索；两者结果都是确定的，可直接复用缓存
+    max_new_tokens: int = 64
+    model: Optional[str] = None  # 默认使用 SUMMARIZE_MODEL
+    request_id: Optional[str] = None
+    timeout: Optional[float] = None
+
+
+# 生成参数：采样模式使用 temperature / top_p / top_k，贪心模式不需要这些参数
+def sampling_kwargs(do_sample, temperature, top_p, top_k=None):
+    if not do_sample:
+        return {"do_sample": False}
+    kwargs = {"do_sample": True, "temperature": temperature, "top_p": top_p}
+    if top_k is not None:
+        kwargs["top_k"] = top_k
+    return kwargs
+
+
+# 按总长度 max_length 补全时至少生成的 token 数：提示超过 max_length - MIN_NEW_TOKENS 个 token 时从左侧截断
+MIN_NEW_TOKENS = 32
+
+
+def prompt_token_limit(max_length, min_new_tokens=MIN_NEW_TOKENS):
+    """按总长度补全时提示最多保留的 token 数"""
+    return max(1, max_length - min_new_tokens)
+
+
+# 编码提示：有编码缓存时复用已编码的提示前缀，否则直接调用分词器；指定 max_tokens 时超长提示从左侧截断
+def tokenize_prompts(tokenizer, prompts, device, encoding_cache=None, max_tokens=None):
+    if encoding_cache is not None:
+        return encoding_cache.batch(prompts, device, max_tokens)
+    if max_tokens is None:
+        inputs = tokenizer(prompts, return_tensors="pt", padding=True)
+    else:
+        encoded = [ids[-max_tokens:] for ids in tokenizer(prompts)["input_ids"]]
+        inputs = tokenizer.pad({"input_ids": encoded}, return_tensors="pt")
+    return {k: v.to(device) for k, v in inputs.items()}
+
+
+# 调用 model.generate；单条序列生成时优先使用草稿模型做投机解码，否则复用前缀 KV 缓存，只为未见过的后缀做 prefill
+def run_generate(model, inputs, prefix_cache=None, draft=None, **generate_kwargs):
+    input_ids = inputs["input_ids"]
+    single = input_ids.shape[0] == 1 and generate_kwargs.get("num_return_sequences", 1) == 1
+    if draft is not None and single:
+        # 主模型带入前缀缓存时草稿模型的缓存与之不一致，投机解码不使用前缀缓存
+        return draft.generate(model, inputs, **generate_kwargs)
+    if prefix_cache is None or prefix_cache.max_bytes <= 0 or input_ids.shape[0] != 1 or generate_kwargs.get("num_return_sequences", 1) != 1:
+        return model.generate(**inputs, **generate_kwargs)
+
+    _, past_key_values = prefix_cache.lookup(input_ids[0].tolist())
+    outputs = model.generate(**inputs, past_key_values=past_key_values, return_dict_in_generate=True, **generate_kwargs)
+    # 缓存整条序列（提示 + 生成结果）的 KV：编辑器中下一次补全的提示通常以本次结果开头
+    length = min(cache_length(outputs.past_key_values), outputs.sequences.shape[1])
+    prefix_cache.insert(outputs.sequences[0, :length].tolist(), outputs.past_key_values)
+    return outputs.sequences
+
+
+# 生成函数代码的函数（批量）
+# num_return_sequences > 1 时每个函数名返回多个候选，结果按函数名顺序展开为 len(function_names) * num_return_sequences 条
+def generate_function_code_batch(function_names, tokenizer, model, device, max_new_tokens=200, do_sample=True,
+                                 prefix_cache=None, num_return_sequences=1, draft=None, encoding_cache=None,
+                                 cancel_tokens=None):
+    prompts = [f"# 生成一个名为 {function_name} 的 Python 函数。\n\ndef {function_name}(" for function_name in function_names]
+    with stage_seconds.time(stage="tokenize", task="generate_code"):
+        inputs = tokenize_prompts(tokenizer, prompts, device, encoding_cache)
+    input_length = inputs["input_ids"].shape[1]
+    # generate 会把每条提示重复 num_return_sequences 次，停止条件和结果需要按相同方式展开
+    prompts = [prompt for prompt in prompts for _ in range(num_return_sequences)]
+    function_names = [name for name in function_names for _ in range(num_return_sequences)]
+    batch_sizes.observe(len(prompts), task="generate_code")
+    # 函数写完（空行、缩进结束或出现新的顶层定义）后立即停止该序列
+    timer = GenerationTimer(input_length)
+    stopping_criteria = StoppingCriteriaList([
+        timer,
+        CodeStoppingCriteria(tokenizer, prompts, input_length, FUNCTION_STOP_RULES, max_new_tokens)
+    ])
+    if cancel_tokens is not None:
+        stopping_criteria.append(CancelCriteria([token for token in cancel_tokens for _ in range(num_return_sequences)]))
 
     try:
         with torch.no_grad():
-            output_ids = model.generate(
-                input_ids,
+            output_ids = run_generate(
+                model,
+                inputs,
+                prefix_cache,
+                draft,
+                stopping_criteria=stopping_criteria,
                 max_new_tokens=max_new_tokens,
-                temperature=0.3,
-                top_p=0.9,
                 eos_token_id=tokenizer.eos_token_id,
                 pad_token_id=tokenizer.pad_token_id,
-                num_return_sequences=1,
-                do_sample=True
+                num_return_sequences=num_return_sequences,
+                **sampling_kwargs(do_sample, temperature=0.3, top_p=0.9)
             )
-        generated_text = tokenizer.decode(output_ids[0], skip_special_tokens=True)
-        function_code_start = generated_text.find(f"def {function_name}")
-        if function_code_start != -1:
-            function_code = generated_text[function_code_start:]
-            end_index = function_code.find('\n\n')
-            if end_index != -1:
-                function_code = function_code[:end_index]
-            return function_code.strip()
     except Exception as e:
-        logger.error(f"Error in generate_function_code: {e}")
-        return ""
-    return ""
+        logger.error(f"Error in generate_function_code_batch: {e}")
+        return [""] * len(function_names)
+    record_generation(timer, "generate_code", len(prompts), count_generated_tokens(
+        output_ids[:, input_length:], (tokenizer.eos_token_id, tokenizer.pad_token_id)))
 
+    # 只解码新生成的 token：提示以 "def 函数名(" 结尾，生成文本就是函数签名之后的部分
+    with stage_seconds.time(stage="detokenize", task="generate_code"):
+        bodies = tokenizer.batch_decode(output_ids[:, input_length:], skip_special_tokens=True)
 
-# 代码补全的函数
-def complete_code(tokenizer, model, prompt, device, max_length=300, top_p=0.90, top_k=30, temperature=0.3):
-    inputs = tokenizer(prompt, return_tensors="pt")
-    inputs = {k: v.to(device) for k, v in inputs.items()}
+    results = []
+    with stage_seconds.time(stage="postprocess", task="generate_code"):
+        for prompt, function_name, body in zip(prompts, function_names, bodies):
+            end_index, _ = find_stop(prompt, body, FUNCTION_STOP_RULES)
+            if end_index != -1:
+                body = body[:end_index]
+            results.append((f"def {function_name}(" + body).strip() if body.strip() else "")
+    return results
+
+
+# 生成函数代码的函数
+def generate_function_code(function_name, tokenizer, model, device, max_new_tokens=200, do_sample=True,
+                           prefix_cache=None):
+    return generate_function_code_batch([function_name], tokenizer, model, device, max_new_tokens, do_sample,
+                                        prefix_cache)[0]
+
+
+# 代码补全的函数（批量）
+# max_length 是每条提示自身的总长度上限（提示 + 生成），与同批其他提示无关；
+# 提示超过 max_length - min_new_tokens 个 token 时从左侧截断，保证至少能生成 min_new_tokens 个 token
+def complete_code_batch(tokenizer, model, prompts, device, max_length=300, top_p=0.90, top_k=30, temperature=0.3,
+                        do_sample=True, prefix_cache=None, draft=None, encoding_cache=None, cancel_tokens=None,
+                        min_new_tokens=MIN_NEW_TOKENS):
+    with stage_seconds.time(stage="tokenize", task="complete_code"):
+        inputs = tokenize_prompts(tokenizer, prompts, device, encoding_cache,
+                                  max_tokens=prompt_token_limit(max_length, min_new_tokens))
+    input_length = inputs["input_ids"].shape[1]
+    # 左填充后各行的实际提示长度不同，每行的生成预算按自己的长度计算
+    budgets = [max_length - length for length in inputs["attention_mask"].sum(dim=1).tolist()]
+    batch_sizes.observe(len(prompts), task="complete_code")
+    # 当前代码单元补全完整后立即停止该序列
+    timer = GenerationTimer(input_length)
+    stopping_criteria = StoppingCriteriaList([
+        timer,
+        RowBudgetCriteria(input_length, budgets),
+        CodeStoppingCriteria(tokenizer, prompts, input_length, COMPLETION_STOP_RULES, max(budgets))
+    ])
+    if cancel_tokens is not None:
+        stopping_criteria.append(CancelCriteria(cancel_tokens))
 
     try:
         with torch.no_grad():
-            outputs = model.generate(
-                **inputs,
-                max_length=max_length,
+            outputs = run_generate(
+                model,
+                inputs,
+                prefix_cache,
+                draft,
+                stopping_criteria=stopping_criteria,
+                max_new_tokens=max(budgets),
                 pad_token_id=tokenizer.eos_token_id,
-                do_sample=True,
-                top_p=top_p,
-                top_k=top_k,
-                temperature=temperature
+                **sampling_kwargs(do_sample, temperature=temperature, top_p=top_p, top_k=top_k)
             )
+    except Exception as e:
+        logger.error(f"Error in complete_code_batch: {e}")
+        return [""] * len(prompts)
+    record_generation(timer, "complete_code", len(prompts),
+                      count_generated_tokens(outputs[:, input_length:], (tokenizer.eos_token_id,)))
+
+    # 只解码新生成的 token 再拼到原始提示后面，不依赖解码结果能否还原提示的字符长度
+    with stage_seconds.time(stage="detokenize", task="complete_code"):
+        generated_texts = tokenizer.batch_decode(
+            [row[input_length:input_length + budget] for row, budget in zip(outputs, budgets)],
+            skip_special_tokens=True
+        )
+
+    results = []
+    with stage_seconds.time(stage="postprocess", task="complete_code"):
+        for prompt, generated_text in zip(prompts, generated_texts):
+            stop_pos, _ = find_stop(prompt, generated_text, COMPLETION_STOP_RULES)
+            if stop_pos != -1:
+                generated_text = generated_text[:stop_pos]
+            results.append(prompt + generated_text)
+    return results
+
+
+# 代码补全的函数
+def complete_code(tokenizer, model, prompt, device, max_length=300, top_p=0.90, top_k=30, temperature=0.3,
+                  do_sample=True, prefix_cache=None):
+    return complete_code_batch(tokenizer, model, [prompt], device, max_length, top_p, top_k, temperature, do_sample,
+                               prefix_cache)[0]
 
-        completed_code = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        prompt_length = len(prompt)
-        generated_text = completed_code[prompt_length:]
-        stop_pos = generated_text.find("def ")
+
+# 代码摘要的函数（批量）：编码器一次编码整批代码，解码器从起始 token 开始生成
+def summarize_code_batch(tokenizer, model, codes, device, num_beams=1, max_new_tokens=64, cancel_tokens=None):
+    batch_sizes.observe(len(codes), task="summarize_code")
+    timer = GenerationTimer(1)  # 解码器输入只有起始 token
+    stopping_criteria = StoppingCriteriaList([timer])
+    if cancel_tokens is not None:
+        stopping_criteria.append(CancelCriteria(cancel_tokens))
+    try:
+        with stage_seconds.time(stage="generate", task="summarize_code"):
+            output_ids = generate_summary_ids(tokenizer, model, codes, device, max_new_tokens=max_new_tokens,
+                                              num_beams=num_beams, stopping_criteria=stopping_criteria)
+    except Exception as e:
+        logger.error(f"Error in summarize_code_batch: {e}")
+        return [""] * len(codes)
+    # 第一个位置是解码起始 token，不是生成的
+    record_generation(timer, "summarize_code", len(codes), count_generated_tokens(
+        output_ids[:, 1:], (tokenizer.eos_token_id, tokenizer.pad_token_id)))
+    with stage_seconds.time(stage="detokenize", task="summarize_code"):
+        return decode_summaries(tokenizer, output_ids)
+
+
+# 多候选生成：提示只做一次 prefill，KV 缓存复制 num_candidates 份后在同一次 generate 中解码
+# 返回 [(生成文本, 平均对数概率)]，生成文本已按停止规则截断
+def generate_candidates(tokenizer, model, prompt, device, num_candidates, rules, task, max_new_tokens=None,
+                        max_length=None, encoding_cache=None, cancel=None, **generate_kwargs):
+    # 按总长度限制时与批量补全相同：超长提示从左侧截断，至少生成 MIN_NEW_TOKENS 个 token
+    max_tokens = prompt_token_limit(max_length) if max_length is not None else None
+    with stage_seconds.time(stage="tokenize", task=task):
+        inputs = tokenize_prompts(tokenizer, [prompt], device, encoding_cache, max_tokens)
+    input_length = inputs["input_ids"].shape[1]
+    if max_length is not None:
+        max_new_tokens = max_length - input_length
+    batch_sizes.observe(num_candidates, task=task)
+    timer = GenerationTimer(input_length)
+    stopping_criteria = StoppingCriteriaList([
+        timer,
+        CodeStoppingCriteria(tokenizer, [prompt] * num_candidates, input_length, rules, max_new_tokens),
+        CancelCriteria([cancel] * num_candidates)
+    ])
+
+    with torch.no_grad():
+        if input_length > 1:
+            # 最后一个 token 留给 generate，使其从缓存之后继续计算
+            past_key_values = model(
+                input_ids=inputs["input_ids"][:, :-1],
+                attention_mask=inputs["attention_mask"][:, :-1],
+                use_cache=True
+            ).past_key_values
+            generate_kwargs["past_key_values"] = repeat_cache(past_key_values, num_candidates)
+        outputs = model.generate(
+            input_ids=inputs["input_ids"].repeat(num_candidates, 1),
+            attention_mask=inputs["attention_mask"].repeat(num_candidates, 1),
+            stopping_criteria=stopping_criteria,
+            max_new_tokens=max_new_tokens,
+            output_logits=True,
+            return_dict_in_generate=True,
+            **generate_kwargs
+        )
+        # 用未经 temperature / top_p 处理的 logits 计算每个 token 的对数概率
+        logprobs = model.compute_transition_scores(outputs.sequences, outputs.logits, normalize_logits=True)
+
+    new_tokens = outputs.sequences[:, input_length:]
+    # 序列结束（生成结束符或被停止条件停止）之后的位置是填充，不计入平均值和生成的 token 数
+    pad_token_id = generate_kwargs.get("pad_token_id", tokenizer.eos_token_id)
+    finished = (new_tokens == tokenizer.eos_token_id) | (new_tokens == pad_token_id)
+    mask = finished.long().cumsum(dim=1) == 0
+    record_generation(timer, task, num_candidates, int(mask.sum()))
+    mean_logprobs = torch.where(mask, logprobs, 0).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+    with stage_seconds.time(stage="detokenize", task=task):
+        texts = tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+    results = []
+    for text, mean_logprob in zip(texts, mean_logprobs.tolist()):
+        stop_pos, _ = find_stop(prompt, text, rules)
         if stop_pos != -1:
-            completed_code = completed_code[:prompt_length + stop_pos]
-        return completed_code
+            text = text[:stop_pos]
+        results.append((text, mean_logprob))
+    return results
+
+
+# 批量调度器：并发请求在窗口期内合并为一次 generate 调用
+MAX_BATCH_SIZE = int(os.environ.get("CODEGEN_MAX_BATCH_SIZE", "8"))  # 单批最大请求数
+MAX_WAIT_MS = float(os.environ.get("CODEGEN_MAX_WAIT_MS", "10"))  # 凑批最长等待时间（毫秒）
+MAX_QUEUE_SIZE = int(os.environ.get("CODEGEN_MAX_QUEUE_SIZE", "64"))  # 每类请求最多排队数，超出返回 429
+REQUEST_TIMEOUT = float(os.environ.get("CODEGEN_REQUEST_TIMEOUT", "120"))  # 单个请求最长等待时间（秒）
+# 批量生成接口：每次 generate 最多处理的序列数（函数名数 × 候选数），以及单次请求最多的函数名数
+BULK_BATCH_SIZE = int(os.environ.get("CODEGEN_BULK_BATCH_SIZE", "16"))
+MAX_BULK_ITEMS = int(os.environ.get("CODEGEN_MAX_BULK_ITEMS", "512"))
+MAX_RETURN_SEQUENCES = 8
+DISCONNECT_POLL_INTERVAL = float(os.environ.get("CODEGEN_DISCONNECT_POLL_MS", "200")) / 1000  # 检查客户端断开的间隔
+# 代码摘要接口：默认使用的 seq2seq 模型（微调后的 CodeT5），以及束宽和摘要长度的上限
+SUMMARIZE_MODEL = os.environ.get("CODEGEN_SUMMARIZE_MODEL", "codet5")
+MAX_NUM_BEAMS = 8
+MAX_SUMMARY_TOKENS = 128
+
+# 推理执行器：模型只在该工作线程中使用，路由协程只负责等待结果
+executor = InferenceExecutor(max_queue_size=MAX_QUEUE_SIZE)
+
+
+# 批量任务在推理线程中执行：先从注册表取出模型（未加载时在此加载），再调用生成函数
+def generate_batch(function_names, model_name, do_sample, num_return_sequences=1, cancel_tokens=None):
+    loaded = registry.get(model_name)
+    return generate_function_code_batch(
+        function_names, loaded.tokenizer, loaded.model, loaded.device, do_sample=do_sample,
+        prefix_cache=loaded.prefix_cache, num_return_sequences=num_return_sequences, draft=loaded.draft,
+        encoding_cache=loaded.encoding_cache, cancel_tokens=cancel_tokens
+    )
+
+
+def complete_batch(prompts, model_name, do_sample, cancel_tokens=None):
+    loaded = registry.get(model_name)
+    return complete_code_batch(
+        loaded.tokenizer,
+        loaded.model,
+        prompts,
+        loaded.device,
+        max_length=300,  # 默认值
+        top_p=0.90,  # 默认值
+        top_k=30,  # 默认值
+        temperature=0.3,  # 默认值
+        do_sample=do_sample,
+        prefix_cache=loaded.prefix_cache,
+        draft=loaded.draft,
+        encoding_cache=loaded.encoding_cache,
+        cancel_tokens=cancel_tokens
+    )
+
+
+def summarize_codes(codes, model_name, num_beams, max_new_tokens, cancel_tokens=None):
+    loaded = registry.get(model_name)
+    return summarize_code_batch(loaded.tokenizer, loaded.model, codes, loaded.device, num_beams=num_beams,
+                                max_new_tokens=max_new_tokens, cancel_tokens=cancel_tokens)
+
+
+# 多候选任务：同一提示的候选在一次 generate 中生成，按能否解析和平均对数概率排序
+def generate_function_candidates(function_name, model_name, num_candidates, cancel=None):
+    loaded = registry.get(model_name)
+    prompt = f"# 生成一个名为 {function_name} 的 Python 函数。\n\ndef {function_name}("
+    outputs = generate_candidates(
+        loaded.tokenizer, loaded.model, prompt, loaded.device, num_candidates, FUNCTION_STOP_RULES, "generate_code",
+        max_new_tokens=200, encoding_cache=loaded.encoding_cache, cancel=cancel,
+        eos_token_id=loaded.tokenizer.eos_token_id, pad_token_id=loaded.tokenizer.pad_token_id,
+        **sampling_kwargs(True, temperature=0.3, top_p=0.9)
+    )
+    return rank_candidates([
+        {"code": (f"def {function_name}(" + body).strip() if body.strip() else "", "mean_logprob": mean_logprob}
+        for body, mean_logprob in outputs
+    ])
+
+
+def complete_candidates(prompt, model_name, num_candidates, cancel=None):
+    loaded = registry.get(model_name)
+    outputs = generate_candidates(
+        loaded.tokenizer, loaded.model, prompt, loaded.device, num_candidates, COMPLETION_STOP_RULES, "complete_code",
+        max_length=300, encoding_cache=loaded.encoding_cache, cancel=cancel,
+        pad_token_id=loaded.tokenizer.eos_token_id, **sampling_kwargs(True, temperature=0.3, top_p=0.90, top_k=30)
+    )
+    # 没有生成任何内容的候选对用户没有意义，代码置空后在排序时去掉
+    return rank_candidates([
+        {"code": prompt + text if text.strip() else "", "mean_logprob": mean_logprob}
+        for text, mean_logprob in outputs
+    ])
+
+
+# 同一批中的请求必须使用同一个模型，模型名称作为批参数之一
+generate_scheduler = BatchScheduler(
+    generate_batch,
+    executor,
+    max_batch_size=MAX_BATCH_SIZE,
+    max_wait_ms=MAX_WAIT_MS,
+    max_queue_size=MAX_QUEUE_SIZE
+)
+completion_scheduler = BatchScheduler(
+    complete_batch,
+    executor,
+    max_batch_size=MAX_BATCH_SIZE,
+    max_wait_ms=MAX_WAIT_MS,
+    max_queue_size=MAX_QUEUE_SIZE
+)
+
+# 结果缓存：贪心解码的结果是确定的，可以直接复用；采样结果只在请求显式允许时复用
+result_cache = ResultCache(
+    max_size=int(os.environ.get("CODEGEN_CACHE_SIZE", "1024")),  # 0 表示关闭缓存
+    ttl=float(os.environ.get("CODEGEN_CACHE_TTL", "3600")),  # 条目有效期（秒）
+    path=os.environ.get("CODEGEN_CACHE_PATH")  # 设置后缓存持久化到该文件
+)
+atexit.register(result_cache.save)
+
+# 启动后在推理线程中预加载的模型（逗号分隔），不阻塞服务启动
+PRELOAD_MODELS = [name.strip() for name in os.environ.get("CODEGEN_PRELOAD", "").split(",") if name.strip()]
+
+
+@app.on_event("startup")
+async def preload_models():
+    if PRELOAD_MODELS:
+        executor.submit(registry.preload, PRELOAD_MODELS)
+
+
+# 检查候选数：多个候选只能通过采样得到
+def check_num_candidates(request):
+    if not 1 <= request.num_candidates <= MAX_RETURN_SEQUENCES:
+        raise HTTPException(status_code=400, detail=f"num_candidates 必须在 1 到 {MAX_RETURN_SEQUENCES} 之间")
+    if request.num_candidates > 1 and not request.do_sample:
+        raise HTTPException(status_code=400, detail="贪心解码只能生成一个候选")
+
+
+# 在推理线程中生成多个候选，不经过批量调度器和结果缓存；返回排序后的候选列表
+async def run_candidates(job, text, model_name, num_candidates, action, cancel):
+    try:
+        candidates = await executor.run(job, text, model_name, num_candidates, cancel, timeout=cancel.remaining())
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"{action}超时")
     except Exception as e:
-        logger.error(f"Error in complete_code: {e}")
-        return ""
+        logger.error(f"{action}时出错: {e}")
+        raise HTTPException(status_code=500, detail=f"{action}时出错: {str(e)}")
+    if cancel.reason is not None:
+        raise cancelled_error(cancel.reason, action)
+    if not candidates:
+        raise HTTPException(status_code=500, detail="未能生成有效的代码")
+    return candidates
+
+
+# 请求截止时间：请求体中的 timeout 优先，其次是 X-Request-Timeout 请求头，都不超过 REQUEST_TIMEOUT
+def request_timeout(timeout, http_request):
+    if timeout is None:
+        header = http_request.headers.get("x-request-timeout")
+        if header is None:
+            return REQUEST_TIMEOUT
+        try:
+            timeout = float(header)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="X-Request-Timeout 必须是秒数")
+    if timeout <= 0:
+        raise HTTPException(status_code=400, detail="timeout 必须大于 0")
+    return min(timeout, REQUEST_TIMEOUT)
+
+
+# 进行中的请求，POST /cancel/{request_id} 按客户端提供的标识取消
+active_requests = ActiveRequests()
+
+
+def cancelled_error(reason, action):
+    """取消原因对应的错误：超过截止时间返回 504，客户端断开或主动取消返回 499"""
+    if reason == "deadline":
+        return HTTPException(status_code=504, detail=f"{action}超时")
+    return HTTPException(status_code=499, detail="请求已取消")
+
+
+def finish_request(token, request_id):
+    """请求结束：注销 request_id 并记录取消原因"""
+    if request_id:
+        active_requests.remove(request_id, token)
+    if token.cancelled:
+        cancelled_requests.inc(reason=token.reason)
+
+
+async def watch_disconnect(http_request, token):
+    """定期检查客户端是否已断开，断开后取消生成，让推理线程尽快处理排队的任务"""
+    while token.reason is None:
+        if await http_request.is_disconnected():
+            token.cancel("disconnected")
+            return
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+
+
+@contextlib.asynccontextmanager
+async def track_request(http_request, request_id, timeout):
+    """非流式请求的取消标记：登记 request_id，并在等待生成结果期间监视客户端断开"""
+    token = CancelToken(timeout)
+    if request_id:
+        active_requests.add(request_id, token)
+    watcher = asyncio.get_running_loop().create_task(watch_disconnect(http_request, token))
+    try:
+        yield token
+    finally:
+        watcher.cancel()
+        finish_request(token, request_id)
+
+
+# 解析请求中的模型名称，代码生成和补全只支持解码器（causal）模型
+def resolve_model(name, kind="causal"):
+    try:
+        name = registry.resolve(name)
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=str(e.args[0]))
+    if registry.specs[name].kind != kind:
+        raise HTTPException(status_code=400, detail=f"模型 {name} 不支持该任务")
+    return name
 
 
 @app.post("/generate_code/")
-async def generate_code(request: FunctionRequest):
+async def generate_code(request: FunctionRequest, http_request: Request):
     logger.debug("生成函数代码路由被触发")
     function_name = request.function_name.strip()
     if not function_name.isidentifier():
         raise HTTPException(status_code=400, detail="无效的函数名")
+
+    check_num_candidates(request)
+    model_name = resolve_model(request.model)
+    timeout = request_timeout(request.timeout, http_request)
+
+    if request.num_candidates > 1:
+        async with track_request(http_request, request.request_id, timeout) as cancel:
+            candidates = await run_candidates(generate_function_candidates, function_name, model_name,
+                                              request.num_candidates, "生成函数代码", cancel)
+        return {"function_name": function_name, "generated_code": candidates[0]["code"], "candidates": candidates}
+
+    cache_key = None
+    if not request.do_sample or request.reuse_sampled:
+        params = {"max_new_tokens": 200, "temperature": 0.3, "top_p": 0.9, "do_sample": request.do_sample}
+        cache_key = ResultCache.make_key("generate_code", function_name, params, registry.revision(model_name))
+        function_code = result_cache.get(cache_key)
+        if function_code is not None:
+            return {"function_name": function_name, "generated_code": function_code, "cached": True}
+
     try:
-        function_code = generate_function_code(function_name, tokenizer, model, device)
+        async with track_request(http_request, request.request_id, timeout) as cancel:
+            function_code = await generate_scheduler.submit(
+                function_name, timeout=timeout, cancel=cancel, model_name=model_name, do_sample=request.do_sample
+            )
+            if cancel.reason is not None:
+                raise cancelled_error(cancel.reason, "生成函数代码")
         if not function_code:
             raise HTTPException(status_code=500, detail="未能生成有效的函数代码")
+    except HTTPException:
+        raise
+    except GenerationCancelled as e:
+        raise cancelled_error(e.reason, "生成函数代码")
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="生成函数代码超时")
     except Exception as e:
         logger.error(f"生成函数代码时出错: {e}")
         raise HTTPException(status_code=500, detail=f"生成函数代码时出错: {str(e)}")
 
+    if cache_key is not None:
+        result_cache.put(cache_key, function_code)
     return {"function_name": function_name, "generated_code": function_code}
 
 
+# 路由：批量生成函数代码，结果按请求顺序返回，单个函数名出错不影响其他结果
+@app.post("/generate_code/batch")
+async def generate_code_batch(request: FunctionBatchRequest, http_request: Request):
+    if not request.function_names:
+        raise HTTPException(status_code=400, detail="函数名列表不能为空")
+    if len(request.function_names) > MAX_BULK_ITEMS:
+        raise HTTPException(status_code=400, detail=f"单次最多生成 {MAX_BULK_ITEMS} 个函数")
+    num_return_sequences = request.num_return_sequences
+    if not 1 <= num_return_sequences <= MAX_RETURN_SEQUENCES:
+        raise HTTPException(status_code=400, detail=f"num_return_sequences 必须在 1 到 {MAX_RETURN_SEQUENCES} 之间")
+    if num_return_sequences > 1 and not request.do_sample:
+        raise HTTPException(status_code=400, detail="贪心解码只能生成一个候选")
+    model_name = resolve_model(request.model)
+    timeout = request_timeout(request.timeout, http_request)
+
+    results = [None] * len(request.function_names)
+    params = {"max_new_tokens": 200, "temperature": 0.3, "top_p": 0.9, "do_sample": request.do_sample}
+    use_cache = not request.do_sample
+    pending = []  # 需要生成的 (序号, 函数名)
+    for index, function_name in enumerate(request.function_names):
+        function_name = function_name.strip()
+        if not function_name.isidentifier():
+            results[index] = {"function_name": function_name, "error": "无效的函数名"}
+            continue
+        if use_cache:
+            cache_key = ResultCache.make_key("generate_code", function_name, params, registry.revision(model_name))
+            function_code = result_cache.get(cache_key)
+            if function_code is not None:
+                results[index] = {"function_name": function_name, "generated_code": function_code, "cached": True}
+                continue
+        pending.append((index, function_name))
+
+    # 按函数名长度排序后分块，同一块内的提示长度接近，减少填充；每块单独提交，其他请求可以在块之间插队
+    pending.sort(key=lambda item: len(item[1]))
+    chunk_size = max(1, BULK_BATCH_SIZE // num_return_sequences)
+    async with track_request(http_request, request.request_id, timeout) as cancel:
+        for start in range(0, len(pending), chunk_size):
+            chunk = pending[start:start + chunk_size]
+            function_names = [function_name for _, function_name in chunk]
+            outputs = None
+            # 请求已取消或超过截止时间后，剩余的块不再提交
+            if cancel.cancelled:
+                error = cancelled_error(cancel.reason, "生成函数代码").detail
+            else:
+                try:
+                    outputs = await executor.run(
+                        generate_batch,
+                        function_names,
+                        model_name,
+                        request.do_sample,
+                        num_return_sequences,
+                        [cancel] * len(function_names),
+                        timeout=cancel.remaining()
+                    )
+                    if cancel.reason is not None:
+                        outputs, error = None, cancelled_error(cancel.reason, "生成函数代码").detail
+                except QueueFullError as e:
+                    error = str(e)
+                except asyncio.TimeoutError:
+                    error = "生成函数代码超时"
+                except Exception as e:
+                    logger.error(f"批量生成函数代码时出错: {e}")
+                    error = f"生成函数代码时出错: {str(e)}"
+
+            for position, (index, function_name) in enumerate(chunk):
+                if outputs is None:
+                    results[index] = {"function_name": function_name, "error": error}
+                    continue
+                candidates = outputs[position * num_return_sequences:(position + 1) * num_return_sequences]
+                candidates = [code for code in candidates if code]
+                if not candidates:
+                    results[index] = {"function_name": function_name, "error": "未能生成有效的函数代码"}
+                    continue
+                results[index] = {"function_name": function_name, "generated_code": candidates[0]}
+                if num_return_sequences > 1:
+                    results[index]["candidates"] = candidates
+                if use_cache:
+                    cache_key = ResultCache.make_key("generate_code", function_name, params,
+                                                     registry.revision(model_name))
+                    result_cache.put(cache_key, candidates[0])
+
+    return {"results": results}
+
+
 # 路由：代码补全
 @app.post("/complete_code/")
-async def code_completion(request: CodeCompletionRequest):
+async def code_completion(request: CodeCompletionRequest, http_request: Request):
     prompt = request.prompt.strip()
     if not prompt:
         raise HTTPException(status_code=400, detail="提示不能为空")
 
+    check_num_candidates(request)
+    model_name = resolve_model(request.model)
+    timeout = request_timeout(request.timeout, http_request)
+
+    if request.num_candidates > 1:
+        async with track_request(http_request, request.request_id, timeout) as cancel:
+            candidates = await run_candidates(complete_candidates, prompt, model_name, request.num_candidates,
+                                              "代码补全", cancel)
+        return {"prompt": prompt, "completed_code": candidates[0]["code"], "candidates": candidates}
+
+    cache_key = None
+    if not request.do_sample or request.reuse_sampled:
+        params = {"max_length": 300, "top_p": 0.90, "top_k": 30, "temperature": 0.3, "do_sample": request.do_sample}
+        cache_key = ResultCache.make_key("complete_code", prompt, params, registry.revision(model_name))
+        completed_code = result_cache.get(cache_key)
+        if completed_code is not None:
+            return {"prompt": prompt, "completed_code": completed_code, "cached": True}
+
     try:
-        completed_code = complete_code(
-            tokenizer,
-            model,
-            prompt,
-            device,
-            max_length=300,  # 默认值
-            top_p=0.90,  # 默认值
-            top_k=30,  # 默认值
-            temperature=0.3  # 默认值
-        )
+        async with track_request(http_request, request.request_id, timeout) as cancel:
+            completed_code = await completion_scheduler.submit(
+                prompt, timeout=timeout, cancel=cancel, model_name=model_name, do_sample=request.do_sample
+            )
+            if cancel.reason is not None:
+                raise cancelled_error(cancel.reason, "代码补全")
         if not completed_code:
             raise HTTPException(status_code=500, detail="未能生成有效的补全代码")
+    except HTTPException:
+        raise
+    except GenerationCancelled as e:
+        raise cancelled_error(e.reason, "代码补全")
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="代码补全超时")
     except Exception as e:
         logger.error(f"生成代码时出错: {e}")
         raise HTTPException(status_code=500, detail=f"生成代码时出错: {str(e)}")
 
+    if cache_key is not None:
+        result_cache.put(cache_key, completed_code)
     return {"prompt": prompt, "completed_code": completed_code}
 
-print(app.routes)  # 打印所有路由
+
+# 流式生成：在推理线程中运行 generate，通过 streamer 逐段取回新 token 的文本
+def stream_generate(loaded, prompt, rules, max_new_tokens=None, max_length=None, cancel=None, **generate_kwargs):
+    tokenizer = loaded.tokenizer
+    # 按总长度限制时与批量补全相同：超长提示从左侧截断，至少生成 MIN_NEW_TOKENS 个 token
+    max_tokens = prompt_token_limit(max_length) if max_length is not None else None
+    with stage_seconds.time(stage="tokenize", task="stream"):
+        inputs = tokenize_prompts(tokenizer, [prompt], loaded.device, loaded.encoding_cache, max_tokens)
+    if max_length is not None:
+        max_new_tokens = max_length - inputs["input_ids"].shape[1]
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=REQUEST_TIMEOUT)
+
+    def run():
+        if cancel is not None and cancel.cancelled:
+            streamer.end()  # 排队期间已取消（客户端断开或超过截止时间），不再生成
+            return
+        timer = GenerationTimer(inputs["input_ids"].shape[1])  # 在推理线程中开始计时，不包含排队时间
+        stopping_criteria = StoppingCriteriaList([
+            timer,
+            CodeStoppingCriteria(tokenizer, [prompt], inputs["input_ids"].shape[1], rules, max_new_tokens),
+            CancelCriteria([cancel])
+        ])
+        try:
+            with torch.no_grad():
+                run_generate(
+                    loaded.model,
+                    inputs,
+                    loaded.prefix_cache,
+                    loaded.draft,
+                    streamer=streamer,
+                    stopping_criteria=stopping_criteria,
+                    max_new_tokens=max_new_tokens,
+                    **generate_kwargs
+                )
+        except Exception as e:
+            logger.error(f"Error in stream_generate: {e}")
+            streamer.end()  # 结束迭代，避免客户端一直等待
+            return
+        record_generation(timer, "stream", 1)
+
+    executor.submit(run)  # 队列已满时抛出 QueueFullError
+    return streamer
+
+
+# 流式请求需要先拿到分词器才能创建 streamer，模型未加载时先在推理线程中加载
+async def load_for_stream(model_name):
+    try:
+        return await executor.run(registry.get, model_name, timeout=REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="加载模型超时")
+    except (OSError, ValueError) as e:
+        logger.error(f"加载模型 {model_name} 出错: {e}")
+        raise HTTPException(status_code=500, detail=f"加载模型出错: {str(e)}")
+
+
+def sse_event(data):
+    """按 Server-Sent Events 格式编码一条消息"""
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def stream_events(streamer, prompt, rules, result_key, head="", result_prefix="", cancel=None):
+    """逐段读取生成结果，增量应用停止规则，只发送停止点之前的文本
+
+    head 作为第一段文本发送，最终结果为 result_prefix + head + 生成文本
+    """
+    text = ""
+    sent = 0
+    if head:
+        yield sse_event({"text": head})
+    try:
+        for chunk in streamer:
+            text += chunk
+            stop_pos, _ = find_stop(prompt, text, rules)
+            if stop_pos != -1:
+                text = text[:stop_pos]
+                break
+            safe = safe_length(prompt, text)
+            if safe > sent:
+                yield sse_event({"text": text[sent:safe]})
+                sent = safe
+    except Exception as e:
+        logger.error(f"流式生成出错: {e}")
+        yield sse_event({"error": f"生成代码时出错: {str(e)}"})
+        return
+
+    if cancel is not None and cancel.reason is not None:
+        yield sse_event({"error": cancelled_error(cancel.reason, "生成代码").detail})
+        return
+    if len(text) > sent:
+        yield sse_event({"text": text[sent:]})
+    yield sse_event({"done": True, result_key: result_prefix + head + text})
+
+
+# 流式请求的取消标记：在 stream_with_cancel 结束时注销
+def register_stream(request_id, timeout):
+    cancel = CancelToken(timeout)
+    if request_id:
+        active_requests.add(request_id, cancel)
+    return cancel
+
+
+async def stream_with_cancel(events, cancel, request_id, http_request):
+    """发送流式事件，同时监视客户端断开
+
+    停止规则会暂缓发送未完成的行，stream_events 可能长时间不产出事件，StreamingResponse 无法及时发现断开，
+    因此单独轮询连接状态；迭代被中途取消时同样取消仍在进行的生成
+    """
+    watcher = asyncio.get_running_loop().create_task(watch_disconnect(http_request, cancel))
+    completed = False
+    if not hasattr(events, "__aiter__"):
+        events = iterate_in_threadpool(events)  # 同步迭代器在线程池中读取，不阻塞事件循环
+    try:
+        async for event in events:
+            yield event
+        completed = True
+    finally:
+        watcher.cancel()
+        if not completed:
+            cancel.cancel("disconnected")
+        finish_request(cancel, request_id)
+
+
+# 路由：流式生成函数代码（SSE）
+@app.post("/generate_code/stream")
+async def generate_code_stream(request: FunctionRequest, http_request: Request):
+    function_name = request.function_name.strip()
+    if not function_name.isidentifier():
+        raise HTTPException(status_code=400, detail="无效的函数名")
+
+    model_name = resolve_model(request.model)
+    timeout = request_timeout(request.timeout, http_request)
+    prompt = f"# 生成一个名为 {function_name} 的 Python 函数。\n\ndef {function_name}("
+    cancel = register_stream(request.request_id, timeout)
+    try:
+        loaded = await load_for_stream(model_name)
+        streamer = stream_generate(
+            loaded,
+            prompt,
+            FUNCTION_STOP_RULES,
+            max_new_tokens=200,
+            cancel=cancel,
+            eos_token_id=loaded.tokenizer.eos_token_id,
+            pad_token_id=loaded.tokenizer.pad_token_id,
+            **sampling_kwargs(request.do_sample, temperature=0.3, top_p=0.9)
+        )
+    except Exception as e:
+        finish_request(cancel, request.request_id)
+        if isinstance(e, QueueFullError):
+            raise HTTPException(status_code=429, detail=str(e))
+        raise
+
+    return StreamingResponse(
+        stream_with_cancel(
+            stream_events(streamer, prompt, FUNCTION_STOP_RULES, "generated_code", head=f"def {function_name}(",
+                          cancel=cancel),
+            cancel,
+            request.request_id,
+            http_request
+        ),
+        media_type="text/event-stream"
+    )
+
+
+# 路由：流式代码补全（SSE）
+@app.post("/complete_code/stream")
+async def code_completion_stream(request: CodeCompletionRequest, http_request: Request):
+    prompt = request.prompt.strip()
+    if not prompt:
+        raise HTTPException(status_code=400, detail="提示不能为空")
+
+    model_name = resolve_model(request.model)
+    timeout = request_timeout(request.timeout, http_request)
+    cancel = register_stream(request.request_id, timeout)
+    try:
+        loaded = await load_for_stream(model_name)
+        streamer = stream_generate(
+            loaded,
+            prompt,
+            COMPLETION_STOP_RULES,
+            max_length=300,
+            cancel=cancel,
+            pad_token_id=loaded.tokenizer.eos_token_id,
+            **sampling_kwargs(request.do_sample, temperature=0.3, top_p=0.90, top_k=30)
+        )
+    except Exception as e:
+        finish_request(cancel, request.request_id)
+        if isinstance(e, QueueFullError):
+            raise HTTPException(status_code=429, detail=str(e))
+        raise
+
+    return StreamingResponse(
+        stream_with_cancel(
+            stream_events(streamer, prompt, COMPLETION_STOP_RULES, "completed_code", result_prefix=prompt,
+                          cancel=cancel),
+            cancel,
+            request.request_id,
+            http_request
+        ),
+        media_type="text/event-stream"
+    )
+
+
+# 检查摘要请求，返回模型名称：只支持 seq2seq 模型
+def check_summarize_request(request):
+    if not request.codes:
+        raise HTTPException(status_code=400, detail="代码列表不能为空")
+    if len(request.codes) > MAX_BULK_ITEMS:
+        raise HTTPException(status_code=400, detail=f"单次最多生成 {MAX_BULK_ITEMS} 条摘要")
+    if not 1 <= request.num_beams <= MAX_NUM_BEAMS:
+        raise HTTPException(status_code=400, detail=f"num_beams 必须在 1 到 {MAX_NUM_BEAMS} 之间")
+    if not 1 <= request.max_new_tokens <= MAX_SUMMARY_TOKENS:
+        raise HTTPException(status_code=400, detail=f"max_new_tokens 必须在 1 到 {MAX_SUMMARY_TOKENS} 之间")
+    return resolve_model(request.model or SUMMARIZE_MODEL, kind="seq2seq")
+
+
+async def summarize_chunks(codes, model_name, num_beams, max_new_tokens, cancel):
+    """按块产出摘要结果（带 index 的字典列表）：缓存命中的先返回，其余按长度排序后分块在推理线程中生成，
+    每块完成后立即产出；单块出错或请求取消只影响对应条目
+    """
+    params = {"num_beams": num_beams, "max_new_tokens": max_new_tokens}
+    revision = registry.revision(model_name)
+    ready, pending = [], []
+    for index, code in enumerate(codes):
+        if not code.strip():
+            ready.append({"index": index, "error": "代码不能为空"})
+            continue
+        summary = result_cache.get(ResultCache.make_key("summarize_code", code, params, revision))
+        if summary is not None:
+            ready.append({"index": index, "summary": summary, "cached": True})
+        else:
+            pending.append((index, code))
+    if ready:
+        yield ready
+
+    # 长度接近的代码放在同一块，减少编码器的填充；每块单独提交，其他请求可以在块之间插队
+    pending.sort(key=lambda item: len(item[1]))
+    chunk_size = max(1, BULK_BATCH_SIZE // num_beams)
+    for start in range(0, len(pending), chunk_size):
+        chunk = pending[start:start + chunk_size]
+        outputs = None
+        if cancel.cancelled:
+            error = cancelled_error(cancel.reason, "生成代码摘要").detail
+        else:
+            try:
+                outputs = await executor.run(
+                    summarize_codes,
+                    [code for _, code in chunk],
+                    model_name,
+                    num_beams,
+                    max_new_tokens,
+                    [cancel] * len(chunk),
+                    timeout=cancel.remaining()
+                )
+                if cancel.reason is not None:
+                    outputs, error = None, cancelled_error(cancel.reason, "生成代码摘要").detail
+            except QueueFullError as e:
+                error = str(e)
+            except asyncio.TimeoutError:
+                error = "生成代码摘要超时"
+            except Exception as e:
+                logger.error(f"生成代码摘要时出错: {e}")
+                error = f"生成代码摘要时出错: {str(e)}"
+
+        results = []
+        for position, (index, code) in enumerate(chunk):
+            if outputs is None:
+                results.append({"index": index, "error": error})
+            elif not outputs[position]:
+                results.append({"index": index, "error": "未能生成有效的摘要"})
+            else:
+                result_cache.put(ResultCache.make_key("summarize_code", code, params, revision), outputs[position])
+                results.append({"index": index, "summary": outputs[position]})
+        yield results
+
+
+# 路由：批量生成代码摘要，结果按请求顺序返回
+@app.post("/summarize_code/")
+async def summarize_code(request: SummarizeRequest, http_request: Request):
+    model_name = check_summarize_request(request)
+    timeout = request_timeout(request.timeout, http_request)
+    results = [None] * len(request.codes)
+    async with track_request(http_request, request.request_id, timeout) as cancel:
+        async for chunk in summarize_chunks(request.codes, model_name, request.num_beams, request.max_new_tokens,
+                                            cancel):
+            for result in chunk:
+                results[result.pop("index")] = result
+    return {"results": results}
+
+
+# 路由：流式批量生成代码摘要（JSON Lines），每块生成完成后立即输出该块的结果，按 index 对应请求中的代码
+@app.post("/summarize_code/stream")
+async def summarize_code_stream(request: SummarizeRequest, http_request: Request):
+    model_name = check_summarize_request(request)
+    timeout = request_timeout(request.timeout, http_request)
+    cancel = register_stream(request.request_id, timeout)
+
+    async def lines():
+        async for chunk in summarize_chunks(request.codes, model_name, request.num_beams, request.max_new_tokens,
+                                            cancel):
+            for result in chunk:
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        yield json.dumps({"done": True}) + "\n"
+
+    return StreamingResponse(stream_with_cancel(lines(), cancel, request.request_id, http_request),
+                             media_type="application/x-ndjson")
+
+
+# 路由：取消进行中的请求（编辑器中新的按键使上一次补全作废时调用）
+@app.post("/cancel/{request_id}")
+async def cancel_request(request_id: str):
+    if not active_requests.cancel(request_id):
+        raise HTTPException(status_code=404, detail="请求不存在或已结束")
+    return {"request_id": request_id, "cancelled": True}
+
+
+# 路由：停止条件统计（各规则命中次数和节省的 token 数）
+@app.get("/stats/stopping")
+async def stopping_stats():
+    return stop_stats.snapshot()
+
+
+# 路由：结果缓存统计
+@app.get("/stats/cache")
+async def cache_stats():
+    return result_cache.stats()
+
+
+# 路由：前缀 KV 缓存统计（按已加载的模型分别统计）
+@app.get("/stats/prefix_cache")
+async def prefix_cache_stats():
+    return {loaded.spec.name: loaded.prefix_cache.stats() for loaded in registry.loaded() if loaded.prefix_cache}
+
+
+# 路由：投机解码统计（接受率、每轮 token 数和相对普通解码的加速比）
+@app.get("/stats/speculative")
+async def speculative_stats():
+    return {loaded.spec.name: loaded.draft.stats.snapshot() for loaded in registry.loaded() if loaded.draft}
+
+
+# 路由：提示编码缓存统计
+@app.get("/stats/encoding_cache")
+async def encoding_cache_stats():
+    return {loaded.spec.name: loaded.encoding_cache.stats() for loaded in registry.loaded()}
+
+
+# 路由：已登记的模型及加载状态
+@app.get("/models")
+async def list_models():
+    return registry.status()
+
+
+# 路由：健康检查（不经过推理队列，生成任务繁忙时也能立即响应）
+@app.get("/health")
+async def health():
+    return {
+        "status": "ok",
+        "queue_depth": generate_scheduler.pending + completion_scheduler.pending,
+        "executor_queue": executor.qsize(),
+        "active_requests": len(active_requests)
+    }
+
+
+# 请求耗时：按路由模板记录，未匹配的路径合并为一类，避免标签数量无限增长
+# 使用纯 ASGI 中间件而不是 @app.middleware("http")：后者会包装 receive，路由中检测不到客户端断开
+class RequestTimingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                route = scope.get("route")
+                request_seconds.observe(time.perf_counter() - start, route=route.path if route else "other",
+                                        status=message["status"])
+            await send(message)
+
+        await self.app(scope, receive, send_with_timing)
+
+
+app.add_middleware(RequestTimingMiddleware)
+
+
+# 导出时读取的状态：队列深度、缓存命中率、停止条件命中次数、模型内存
+metrics.gauge("codegen_queue_depth", "排队中的请求数", lambda: {
+    (("queue", "generate_code"),): generate_scheduler.pending,
+    (("queue", "complete_code"),): completion_scheduler.pending,
+    (("queue", "executor"),): executor.qsize()
+})
+metrics.counter("codegen_result_cache_hits_total", "结果缓存命中次数", lambda: result_cache.hits)
+metrics.counter("codegen_result_cache_misses_total", "结果缓存未命中次数", lambda: result_cache.misses)
+metrics.gauge("codegen_result_cache_hit_rate", "结果缓存命中率", lambda: result_cache.stats()["hit_rate"])
+metrics.gauge("codegen_prefix_cache_hit_rate", "前缀 KV 缓存命中率", lambda: {
+    (("model", loaded.spec.name),): loaded.prefix_cache.stats()["hit_rate"]
+    for loaded in registry.loaded() if loaded.prefix_cache
+})
+metrics.gauge("codegen_encoding_cache_hit_rate", "提示编码缓存命中率（含前缀复用）", lambda: {
+    (("model", loaded.spec.name),): loaded.encoding_cache.stats()["hit_rate"] for loaded in registry.loaded()
+})
+metrics.gauge("codegen_prefix_cache_bytes", "前缀 KV 缓存占用字节数", lambda: {
+    (("model", loaded.spec.name),): loaded.prefix_cache.nbytes for loaded in registry.loaded() if loaded.prefix_cache
+})
+metrics.counter("codegen_stop_rule_hits_total", "各停止条件命中次数", lambda: {
+    (("rule", rule),): hits for rule, hits in stop_stats.snapshot()["hits"].items()
+})
+metrics.gauge("codegen_speculative_acceptance_rate", "投机解码的草稿 token 接受率", lambda: {
+    (("model", loaded.spec.name),): loaded.draft.stats.snapshot()["acceptance_rate"]
+    for loaded in registry.loaded() if loaded.draft
+})
+metrics.gauge("codegen_model_memory_mb", "已加载模型占用的内存（MB）", lambda: {
+    (("model", loaded.spec.name),): loaded.memory_mb for loaded in registry.loaded()
+})
+metrics.gauge("codegen_resident_memory_mb", "进程常驻内存（MB）", resident_memory_mb)
+metrics.gauge("codegen_process_memory_mb", "按共享情况拆分的进程内存（MB），多进程部署时 private 为每个进程的额外开销",
+              lambda: {(("kind", kind),): value for kind, value in process_memory_mb().items()})
+
+
+# 路由：Prometheus 文本格式指标
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
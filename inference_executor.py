@@ -0,0 +1,62 @@
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """推理队列已满，调用方应返回 429"""
+
+
+class InferenceExecutor:
+    """推理执行器：由单个工作线程独占模型，所有推理任务在该线程中串行执行"""
+
+    def __init__(self, max_queue_size=32, name="inference-worker"):
+        self.name = name
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """启动工作线程（首次提交任务时自动调用）"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._worker, name=self.name, daemon=True)
+                self._thread.start()
+
+    def qsize(self):
+        """当前排队中的任务数"""
+        return self._queue.qsize()
+
+    def submit(self, fn, *args, **kwargs):
+        """提交任务，返回 concurrent.futures.Future；队列已满时抛出 QueueFullError"""
+        self.start()
+        future = concurrent.futures.Future()
+        try:
+            self._queue.put_nowait((future, fn, args, kwargs))
+        except queue.Full:
+            raise QueueFullError("推理队列已满，请稍后重试")
+        return future
+
+    async def run(self, fn, *args, timeout=None, **kwargs):
+        """在工作线程中执行任务并等待结果，超时抛出 asyncio.TimeoutError"""
+        future = self.submit(fn, *args, **kwargs)
+        # 超时后 wrap_future 会连带取消原 Future，尚未开始的任务将被工作线程跳过
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+
+    def _worker(self):
+        """工作线程主循环"""
+        while True:
+            future, fn, args, kwargs = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue  # 任务在排队期间已被取消
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                logger.error(f"推理任务出错: {e}")
+                future.set_exception(e)
+            else:
+                future.set_result(result)
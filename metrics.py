@@ -0,0 +1,207 @@
+import bisect
+import threading
+import time
+
+import torch
+from transformers import StoppingCriteria
+
+# 默认直方图分桶（秒），覆盖从单次分词到完整生成的耗时范围
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _SimpleMetric:
+    """计数器和瞬时值的公共部分；设置 callback 时在导出时调用，返回 {标签元组: 值} 或单个数值"""
+    type_name = "untyped"
+
+    def __init__(self, name, documentation, callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        if self.callback is not None:
+            values = self.callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        for key, value in values.items():
+            lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_SimpleMetric):
+    """单调递增计数器"""
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_SimpleMetric):
+    """瞬时值"""
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram:
+    """固定分桶直方图：observe 只做一次二分查找和几次加法，可以常开"""
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._series = {}  # 标签元组 -> [各桶计数, 总和, 总数]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        """计时上下文：with histogram.time(stage="..."): ..."""
+        return _Timer(self, labels)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        for key, (counts, total, count) in series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = key + (("le", _format_value(bound)),)
+                lines.append(f"{self.name}_bucket{_format_labels(labels)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total!r}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class MetricsRegistry:
+    """指标集合，按 Prometheus 文本格式导出"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, callback=None):
+        return self.register(Counter(name, documentation, callback))
+
+    def gauge(self, name, documentation, callback=None):
+        return self.register(Gauge(name, documentation, callback))
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+def count_generated_tokens(new_tokens, stop_token_ids):
+    """各行实际生成的 token 总数：每行只计到第一个结束符或填充符之前
+
+    批量生成时提前停止的序列会被填充到批内最长序列的长度，这些填充不是生成的 token
+    """
+    finished = torch.zeros_like(new_tokens, dtype=torch.bool)
+    for token_id in set(stop_token_ids):
+        if token_id is not None:
+            finished |= new_tokens == token_id
+    return int((finished.long().cumsum(dim=1) == 0).sum())
+
+
+class GenerationTimer(StoppingCriteria):
+    """挂在 stopping_criteria 中记录 prefill 和 decode 耗时，本身从不停止生成
+
+    generate 在得到第一个新 token 后第一次调用停止条件，此前的时间计为 prefill，之后计为 decode；
+    投机解码每轮验证可能接受多个 token，因此 token 数按序列长度计算，steps 为调用轮数
+    """
+
+    def __init__(self, input_length):
+        self.input_length = input_length
+        self.start = time.perf_counter()
+        self.first_token = None
+        self.first_length = input_length
+        self.length = input_length
+        self.steps = 0
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+            self.first_length = input_ids.shape[1]
+        self.length = input_ids.shape[1]
+        self.steps += 1
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+    @property
+    def new_tokens(self):
+        """每条序列生成的 token 数（含已停止序列的填充）"""
+        return self.length - self.input_length
+
+    def record(self, stage_histogram, tokens_counter, batch_size, generated=None, **labels):
+        """生成结束后调用：记录 prefill / decode 耗时和生成的 token 数，返回解码速度（tokens/s）
+
+        generated 为各行实际生成的 token 总数（见 count_generated_tokens）；不提供时按最长序列计算，包含已停止序列的填充
+        """
+        end = time.perf_counter()
+        if self.first_token is None:
+            stage_histogram.observe(end - self.start, stage="prefill", **labels)
+            return 0.0
+        stage_histogram.observe(self.first_token - self.start, stage="prefill", **labels)
+        decode_seconds = end - self.first_token
+        stage_histogram.observe(decode_seconds, stage="decode", **labels)
+        if generated is None:
+            generated = self.new_tokens * batch_size
+        tokens_counter.inc(generated, **labels)
+        # 第一次调用前生成的 token 属于 prefill
+        decode_tokens = max(0, generated - (self.first_length - self.input_length) * batch_size)
+        return decode_tokens / decode_seconds if decode_seconds > 0 else 0.0
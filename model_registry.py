@@ -0,0 +1,347 @@
+import gc
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM, AutoModelForSeq2SeqLM
+
+from cpu_features import cpu_supports_bf16
+from encoding_cache import EncodingCache
+from prefix_cache import PrefixCache
+from speculative_decoding import DraftModel
+
+logger = logging.getLogger(__name__)
+
+# 模型加载模式：
+#   fp32    默认，完整精度权重
+#   int8    Linear 层动态 int8 量化（仅 CPU），内存约为 fp32 的 1/3
+#   bf16    bfloat16 权重，需要 CPU 支持 avx512_bf16 / amx_bf16 或使用 GPU
+#   low_mem low_cpu_mem_usage 加载，有 safetensors 权重时通过 mmap 读取，避免加载期间内存翻倍
+LOAD_MODES = ("fp32", "int8", "bf16", "low_mem")
+
+
+def resident_memory_mb():
+    """当前进程的常驻内存（MB）"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        return 0.0
+
+
+def process_memory_mb():
+    """按共享情况拆分的进程内存（MB）：多进程共享权重时，private 才是每个进程额外占用的内存，pss 按共享进程数分摊"""
+    fields = {"Rss": "rss", "Pss": "pss", "Shared_Clean": "shared", "Shared_Dirty": "shared",
+              "Private_Clean": "private", "Private_Dirty": "private"}
+    memory = {"rss": 0.0, "pss": 0.0, "shared": 0.0, "private": 0.0}
+    try:
+        with open("/proc/self/smaps_rollup", "r") as f:
+            for line in f:
+                key = line.split(":", 1)[0]
+                if key in fields:
+                    memory[fields[key]] += int(line.split()[1]) / 1024
+    except OSError:
+        memory["rss"] = memory["private"] = resident_memory_mb()
+    return memory
+
+
+def tensor_memory_mb(model):
+    """模型参数和缓冲区占用的内存（MB）；动态量化后的权重不在 state_dict 张量中，会偏小"""
+    tensors = [t for t in model.state_dict().values() if torch.is_tensor(t)]
+    return sum(t.nelement() * t.element_size() for t in tensors) / (1024 * 1024)
+
+
+def measure_generation_speed(tokenizer, model, device, num_tokens=32, **generate_kwargs):
+    """用一次固定长度的贪心生成测量解码速度（tokens/s），同时完成预热"""
+    inputs = tokenizer("def main():\n", return_tensors="pt")
+    inputs = {k: v.to(device) for k, v in inputs.items()}
+    start = time.perf_counter()
+    with torch.no_grad():
+        model.generate(
+            **inputs,
+            max_new_tokens=num_tokens,
+            min_new_tokens=num_tokens,
+            do_sample=False,
+            pad_token_id=tokenizer.pad_token_id,
+            **generate_kwargs
+        )
+    return num_tokens / (time.perf_counter() - start)
+
+
+# 模型加载函数，kind 为 causal（CodeGen 等解码器模型）或 seq2seq（CodeT5 等编码器-解码器模型）
+def load_model(model_path, load_mode="fp32", compile_model=False, warmup=True, kind="causal"):
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"模型路径未找到: {model_path}")
+    if load_mode not in LOAD_MODES:
+        raise ValueError(f"未知的加载模式: {load_mode}，可选值: {', '.join(LOAD_MODES)}")
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if load_mode == "int8" and device.type != "cpu":
+        logger.warning("int8 动态量化只支持 CPU，改用 fp32 加载")
+        load_mode = "fp32"
+    if load_mode == "bf16" and device.type == "cpu" and not cpu_supports_bf16():
+        logger.warning("当前 CPU 不支持原生 bf16，bf16 推理会比 fp32 更慢")
+
+    logger.debug(f"加载模型路径: {model_path}, 加载模式: {load_mode}")
+    memory_before = resident_memory_mb()
+    kwargs = {}
+    if load_mode == "bf16":
+        kwargs["torch_dtype"] = torch.bfloat16
+    if load_mode == "low_mem":
+        kwargs["low_cpu_mem_usage"] = True
+        if os.path.exists(os.path.join(model_path, "model.safetensors")):
+            kwargs["use_safetensors"] = True
+    # 使用 Rust 实现的快速分词器；模型目录中只有慢速分词器的词表文件时会回退到 Python 实现
+    tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
+    if not tokenizer.is_fast:
+        logger.warning(f"{model_path} 没有可用的快速分词器，分词会明显变慢")
+    model_class = AutoModelForSeq2SeqLM if kind == "seq2seq" else AutoModelForCausalLM
+    model = model_class.from_pretrained(model_path, **kwargs)
+    model.eval()
+
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+        model.config.pad_token_id = tokenizer.eos_token_id
+    if kind == "causal":
+        # 解码器模型批量生成时需要左填充，保证每条序列的末尾对齐
+        tokenizer.padding_side = "left"
+
+    if load_mode == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    model.to(device)
+    if compile_model:
+        model.forward = torch.compile(model.forward, dynamic=True)
+
+    # 报告常驻内存和解码速度，便于为每台机器选择合适的加载模式
+    message = f"模型加载完成: {model_path}, mode={load_mode}, 常驻内存 {resident_memory_mb():.0f} MB " \
+              f"(模型约 {resident_memory_mb() - memory_before:.0f} MB)"
+    if warmup:
+        if compile_model:
+            measure_generation_speed(tokenizer, model, device)  # 第一次调用触发编译，不计入速度
+        message += f", 解码速度 {measure_generation_speed(tokenizer, model, device):.1f} tokens/s"
+    logger.info(message)
+
+    return tokenizer, model, device
+
+
+# 模型版本：由配置文件和权重文件的大小、修改时间计算，模型更新后旧的缓存结果自动失效
+def get_model_revision(model_path):
+    digest = hashlib.sha1(os.path.abspath(model_path).encode("utf-8"))
+    for name in sorted(os.listdir(model_path)):
+        if name.endswith((".json", ".bin", ".safetensors")):
+            stat = os.stat(os.path.join(model_path, name))
+            digest.update(f"{name}:{stat.st_size}:{int(stat.st_mtime)}".encode("utf-8"))
+    return digest.hexdigest()[:12]
+
+
+class ModelSpec:
+    """模型登记信息"""
+
+    def __init__(self, name, path, kind="causal", load_mode="fp32", compile_model=False, prefix_cache_mb=512,
+                 draft_path=None, num_assistant_tokens=5):
+        self.name = name
+        self.path = path
+        self.kind = kind  # causal / seq2seq
+        self.load_mode = load_mode
+        self.compile_model = compile_model
+        self.prefix_cache_mb = prefix_cache_mb  # 前缀 KV 缓存上限，只对 causal 模型有效
+        self.draft_path = draft_path  # 投机解码使用的草稿模型，只对 causal 模型有效
+        self.num_assistant_tokens = num_assistant_tokens  # 草稿模型每轮提出的 token 数
+
+    def to_dict(self):
+        return {"name": self.name, "path": self.path, "kind": self.kind, "load_mode": self.load_mode,
+                "draft_path": self.draft_path}
+
+
+class LoadedModel:
+    """已加载的模型及其附属状态（前缀 KV 缓存只对同一个模型有效，随模型一起卸载）"""
+
+    def __init__(self, spec, tokenizer, model, device, revision, memory_mb):
+        self.spec = spec
+        self.tokenizer = tokenizer
+        self.model = model
+        self.device = device
+        self.revision = revision
+        self.memory_mb = memory_mb
+        self.prefix_cache = None
+        if spec.kind == "causal":
+            self.prefix_cache = PrefixCache(max_bytes=int(spec.prefix_cache_mb * 1024 * 1024))
+        self.draft = None  # DraftModel，配置了草稿模型时设置
+        self.encoding_cache = EncodingCache(tokenizer)
+        self.last_used = time.time()
+
+
+class ModelRegistry:
+    """模型注册表：按名称登记多个模型，首次使用时才加载，常驻模型超出内存预算时按 LRU 卸载"""
+
+    def __init__(self, specs, default_model, memory_budget_mb=0, warmup=True):
+        self.specs = {spec.name: spec for spec in specs}
+        if default_model not in self.specs:
+            raise ValueError(f"默认模型未登记: {default_model}")
+        self.default_model = default_model
+        self.memory_budget_mb = memory_budget_mb  # 0 表示不限制
+        self.warmup = warmup
+        self._loaded = OrderedDict()  # 名称 -> LoadedModel，按最近使用排序
+        self._revisions = {}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_env(cls):
+        """从环境变量创建注册表
+
+        CODEGEN_MODEL_CONFIG 指向 JSON 配置文件，例如：
+            {"default": "codegen", "memory_budget_mb": 8192,
+             "models": {"codegen": {"path": "/models/codegen", "load_mode": "int8"},
+                        "codet5": {"path": "/models/finetuned_codet5_small", "kind": "seq2seq"}}}
+        未设置时登记 CODEGEN_MODEL_PATH（代码生成/补全）和 CODET5_MODEL_PATH（代码摘要）两个模型
+        """
+        load_mode = os.environ.get("CODEGEN_LOAD_MODE", "fp32")  # fp32 / int8 / bf16 / low_mem
+        compile_model = os.environ.get("CODEGEN_COMPILE", "0") == "1"  # 是否用 torch.compile 编译前向计算
+        prefix_cache_mb = float(os.environ.get("CODEGEN_PREFIX_CACHE_MB", "512"))
+        warmup = os.environ.get("CODEGEN_WARMUP", "1") == "1"  # 加载时预热并测量解码速度
+        num_assistant_tokens = int(os.environ.get("CODEGEN_DRAFT_TOKENS", "5"))
+        memory_budget_mb = float(os.environ.get("CODEGEN_MEMORY_BUDGET_MB", "0"))
+
+        config_path = os.environ.get("CODEGEN_MODEL_CONFIG")
+        if config_path:
+            with open(config_path, "r", encoding="utf-8") as f:
+                config = json.load(f)
+            specs = [
+                ModelSpec(
+                    name,
+                    options["path"],
+                    kind=options.get("kind", "causal"),
+                    load_mode=options.get("load_mode", load_mode),
+                    compile_model=options.get("compile", compile_model),
+                    prefix_cache_mb=options.get("prefix_cache_mb", prefix_cache_mb),
+                    draft_path=options.get("draft_path"),
+                    num_assistant_tokens=options.get("num_assistant_tokens", num_assistant_tokens)
+                )
+                for name, options in config["models"].items()
+            ]
+            default_model = config.get("default", specs[0].name)
+            memory_budget_mb = config.get("memory_budget_mb", memory_budget_mb)
+        else:
+            specs = [
+                ModelSpec("codegen", os.environ.get("CODEGEN_MODEL_PATH", r"D:\PythonCode\CodeBERT\model\codegen"),
+                          load_mode=load_mode, compile_model=compile_model, prefix_cache_mb=prefix_cache_mb,
+                          draft_path=os.environ.get("CODEGEN_DRAFT_MODEL_PATH"),
+                          num_assistant_tokens=num_assistant_tokens),
+                ModelSpec("codet5",
+                          os.environ.get("CODET5_MODEL_PATH", "D:/PythonCode/CodeBERT/model/finetuned_codet5_small"),
+                          kind="seq2seq", load_mode=load_mode, compile_model=compile_model),
+            ]
+            default_model = "codegen"
+        return cls(specs, default_model, memory_budget_mb, warmup)
+
+    def resolve(self, name=None):
+        """返回模型名称（None 表示默认模型），未登记时抛出 KeyError"""
+        name = name or self.default_model
+        if name not in self.specs:
+            raise KeyError(f"未登记的模型: {name}")
+        return name
+
+    def revision(self, name=None):
+        """模型版本（用于结果缓存键），无需加载模型"""
+        name = self.resolve(name)
+        with self._lock:
+            if name not in self._revisions:
+                spec = self.specs[name]
+                revision = get_model_revision(spec.path) if os.path.isdir(spec.path) else "missing"
+                self._revisions[name] = f"{revision}-{spec.load_mode}"
+            return self._revisions[name]
+
+    def get(self, name=None):
+        """返回已加载的模型，未加载时立即加载（应在推理线程中调用）"""
+        name = self.resolve(name)
+        with self._lock:
+            loaded = self._loaded.get(name)
+            if loaded is None:
+                spec = self.specs[name]
+                memory_before = resident_memory_mb()
+                tokenizer, model, device = load_model(
+                    spec.path, spec.load_mode, spec.compile_model, self.warmup, kind=spec.kind
+                )
+                # 常驻内存增量包含加载期间的临时分配，取两者较大值作为估计，宁可早卸载也不超出预算
+                memory_mb = max(tensor_memory_mb(model), resident_memory_mb() - memory_before)
+                loaded = LoadedModel(spec, tokenizer, model, device, self.revision(name), memory_mb)
+                if spec.draft_path and spec.kind == "causal":
+                    self._load_draft(loaded)
+                self._loaded[name] = loaded
+                self._evict(keep=name)
+            self._loaded.move_to_end(name)
+            loaded.last_used = time.time()
+            return loaded
+
+    def _load_draft(self, loaded):
+        """加载草稿模型；加载时预热的话，分别测量普通解码和投机解码的速度"""
+        spec = loaded.spec
+        memory_before = resident_memory_mb()
+        draft_tokenizer, draft_model, _ = load_model(spec.draft_path, spec.load_mode, warmup=False)
+        if draft_tokenizer.get_vocab() != loaded.tokenizer.get_vocab():
+            logger.warning(f"草稿模型 {spec.draft_path} 与 {spec.name} 的词表不同，不使用投机解码")
+            return
+        loaded.memory_mb += max(tensor_memory_mb(draft_model), resident_memory_mb() - memory_before)
+        loaded.draft = DraftModel(draft_model, spec.num_assistant_tokens)
+        if self.warmup:
+            baseline = measure_generation_speed(loaded.tokenizer, loaded.model, loaded.device)
+            assisted = measure_generation_speed(loaded.tokenizer, loaded.model, loaded.device,
+                                                **loaded.draft.generate_kwargs())
+            loaded.draft.stats.baseline_speed = baseline
+            logger.info(f"投机解码: 草稿长度 {spec.num_assistant_tokens}, 普通解码 {baseline:.1f} tokens/s, "
+                        f"投机解码 {assisted:.1f} tokens/s (预热提示上 {assisted / baseline:.2f}x)")
+
+    def preload(self, names):
+        for name in names:
+            self.get(name)
+
+    def unload(self, name):
+        with self._lock:
+            if self._loaded.pop(name, None) is not None:
+                logger.info(f"卸载模型: {name}")
+                gc.collect()
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+
+    def memory_mb(self):
+        with self._lock:
+            return sum(loaded.memory_mb for loaded in self._loaded.values())
+
+    def loaded(self):
+        """已加载的模型，按最近使用排序"""
+        with self._lock:
+            return list(self._loaded.values())
+
+    def status(self):
+        with self._lock:
+            return {
+                "default": self.default_model,
+                "memory_budget_mb": self.memory_budget_mb,
+                "models": [
+                    dict(spec.to_dict(), loaded=name in self._loaded,
+                         memory_mb=round(self._loaded[name].memory_mb, 1) if name in self._loaded else 0)
+                    for name, spec in self.specs.items()
+                ]
+            }
+
+    def _evict(self, keep):
+        """超出内存预算时卸载最久未使用的模型（不卸载刚加载的模型）"""
+        if self.memory_budget_mb <= 0:
+            return
+        while self.memory_mb() > self.memory_budget_mb and len(self._loaded) > 1:
+            name = next(iter(self._loaded))
+            if name == keep:
+                break
+            self.unload(name)
@@ -0,0 +1,203 @@
+import threading
+from collections import OrderedDict
+
+from transformers import DynamicCache
+
+
+def cache_layers(past_key_values):
+    """按层返回 KV 缓存中的 (key, value) 张量，兼容新旧版本 transformers 的缓存结构"""
+    if hasattr(past_key_values, "layers"):
+        return [(layer.keys, layer.values) for layer in past_key_values.layers]
+    if hasattr(past_key_values, "key_cache"):
+        return list(zip(past_key_values.key_cache, past_key_values.value_cache))
+    return [(layer[0], layer[1]) for layer in past_key_values]
+
+
+def copy_cache(past_key_values, length):
+    """复制前 length 个位置的 KV 缓存（generate 会原地追加缓存，必须使用副本）"""
+    cache = DynamicCache()
+    for layer_idx, (key, value) in enumerate(cache_layers(past_key_values)):
+        cache.update(key[..., :length, :].clone(), value[..., :length, :].clone(), layer_idx)
+    return cache
+
+
+def repeat_cache(past_key_values, repeats):
+    """把单条序列的 KV 缓存复制 repeats 份（多个候选共用同一次 prefill）"""
+    cache = DynamicCache()
+    for layer_idx, (key, value) in enumerate(cache_layers(past_key_values)):
+        cache.update(key.repeat(repeats, 1, 1, 1), value.repeat(repeats, 1, 1, 1), layer_idx)
+    return cache
+
+
+def cache_length(past_key_values):
+    """KV 缓存覆盖的位置数"""
+    return cache_layers(past_key_values)[0][0].shape[-2]
+
+
+def cache_nbytes(past_key_values):
+    return sum(key.nelement() * key.element_size() + value.nelement() * value.element_size()
+               for key, value in cache_layers(past_key_values))
+
+
+class _Node:
+    """基数树节点：edge 为从父节点到该节点路径上的 token id"""
+    __slots__ = ("edge", "parent", "children", "entry")
+
+    def __init__(self, edge=(), parent=None):
+        self.edge = edge
+        self.parent = parent
+        self.children = {}  # 边的第一个 token id -> 子节点
+        self.entry = None  # 该前缀对应的 KV 缓存条目
+
+
+class _Entry:
+    __slots__ = ("key", "node", "past_key_values", "nbytes", "last_used")
+
+    def __init__(self, key, node, past_key_values):
+        self.key = key
+        self.node = node
+        self.past_key_values = past_key_values
+        self.nbytes = cache_nbytes(past_key_values)
+        self.last_used = 0
+
+
+def _common_length(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class PrefixCache:
+    """前缀 KV 缓存：用基数树按 token id 索引最近的序列，命中后只需为未见过的后缀做 prefill
+
+    条目按 LRU 淘汰，缓存张量总大小不超过 max_bytes
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024, min_prefix=4):
+        self.max_bytes = max_bytes
+        self.min_prefix = min_prefix  # 命中的前缀太短时不值得复制缓存
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self._root = _Node()
+        self._entries = OrderedDict()  # token id 元组 -> _Entry，按最近使用排序
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, token_ids):
+        """查找与 token_ids 共享最长前缀的缓存，返回 (命中长度, KV 缓存副本)，未命中返回 (0, None)
+
+        至少保留最后一个 token 不命中，generate 需要用它计算下一个 token 的 logits
+        """
+        token_ids = tuple(token_ids)
+        with self._lock:
+            node, matched = self._root, 0
+            limit = len(token_ids) - 1
+            while matched < limit:
+                child = node.children.get(token_ids[matched])
+                if child is None:
+                    break
+                k = _common_length(child.edge, token_ids[matched:limit])
+                matched += k
+                node = child
+                if k < len(child.edge):
+                    break  # 停在边的中间，子树中的条目仍共享已匹配的前缀
+
+            entry = self._find_entry(node) if matched >= self.min_prefix else None
+            if entry is None:
+                self.misses += 1
+                return 0, None
+            self._touch(entry)
+            self.hits += 1
+            self.reused_tokens += matched
+            return matched, copy_cache(entry.past_key_values, matched)
+
+    def insert(self, token_ids, past_key_values):
+        """缓存 token_ids 对应的 KV（past_key_values 至少覆盖 len(token_ids) 个位置）"""
+        token_ids = tuple(token_ids)
+        if len(token_ids) < self.min_prefix:
+            return
+        past_key_values = copy_cache(past_key_values, len(token_ids))
+        with self._lock:
+            node = self._insert_node(token_ids)
+            if node.entry is not None:
+                # 覆盖已有条目，节点本身保留
+                del self._entries[node.entry.key]
+                self.nbytes -= node.entry.nbytes
+            entry = _Entry(token_ids, node, past_key_values)
+            node.entry = entry
+            self._entries[token_ids] = entry
+            self._touch(entry)
+            self.nbytes += entry.nbytes
+            while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                self._remove_entry(next(iter(self._entries.values())))
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "reused_tokens": self.reused_tokens
+            }
+
+    def _touch(self, entry):
+        self._clock += 1
+        entry.last_used = self._clock
+        self._entries.move_to_end(entry.key)
+
+    def _find_entry(self, node):
+        """返回子树中最近使用的一个条目"""
+        best = None
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if current.entry is not None and (best is None or current.entry.last_used > best.last_used):
+                best = current.entry
+            stack.extend(current.children.values())
+        return best
+
+    def _insert_node(self, token_ids):
+        node, i = self._root, 0
+        while i < len(token_ids):
+            child = node.children.get(token_ids[i])
+            if child is None:
+                child = _Node(token_ids[i:], node)
+                node.children[token_ids[i]] = child
+                return child
+            k = _common_length(child.edge, token_ids[i:])
+            if k < len(child.edge):
+                # 在公共前缀处拆分边
+                middle = _Node(child.edge[:k], node)
+                node.children[token_ids[i]] = middle
+                child.edge = child.edge[k:]
+                child.parent = middle
+                middle.children[child.edge[0]] = child
+                child = middle
+            node = child
+            i += k
+        return node
+
+    def _remove_entry(self, entry):
+        del self._entries[entry.key]
+        self.nbytes -= entry.nbytes
+        node = entry.node
+        node.entry = None
+        # 向上清理不再有用的节点，并合并只剩一个子节点的中间节点
+        while node is not self._root and node.entry is None and len(node.children) <= 1:
+            parent = node.parent
+            if node.children:
+                (child,) = node.children.values()
+                child.edge = node.edge + child.edge
+                child.parent = parent
+                parent.children[node.edge[0]] = child
+            else:
+                del parent.children[node.edge[0]]
+            node = parent
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_prompt(prompt):
+    """统一换行符并去掉行尾空白，避免仅因格式差异导致缓存未命中"""
+    lines = prompt.replace("\r\n", "\n").strip().split("\n")
+    return "\n".join(line.rstrip() for line in lines)
+
+
+class ResultCache:
+    """生成结果缓存：按 LRU 淘汰，条目超过 TTL 后失效，可选持久化到磁盘"""
+
+    def __init__(self, max_size=1024, ttl=3600, path=None, save_interval=32):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.save_interval = save_interval  # 每写入多少条自动保存一次
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (过期时间戳, 结果)
+        self._dirty = 0
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+
+    @staticmethod
+    def make_key(task, prompt, params, revision):
+        """缓存键：任务类型 + 规范化提示 + 生成参数 + 模型版本"""
+        raw = json.dumps([task, normalize_prompt(prompt), params, revision], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """命中返回结果，未命中或已过期返回 None"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+            self._dirty += 1
+            need_save = self.path and self._dirty >= self.save_interval
+        if need_save:
+            self.save()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+    def save(self):
+        """写入磁盘（先写临时文件再替换，避免中途退出留下损坏的缓存文件）"""
+        if not self.path:
+            return
+        with self._lock:
+            now = time.time()
+            data = {key: entry for key, entry in self._data.items() if entry[0] >= now}
+            self._dirty = 0
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"保存结果缓存失败: {e}")
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"读取结果缓存失败: {e}")
+            return
+        now = time.time()
+        with self._lock:
+            for key, (expire_at, value) in data.items():
+                if expire_at >= now:
+                    self._data[key] = (expire_at, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+        logger.info(f"已加载结果缓存 {len(self._data)} 条: {self.path}")
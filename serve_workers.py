@@ -0,0 +1,149 @@
+"""多进程部署：主进程加载一次模型权重，再 fork 出多个工作进程，各进程以写时复制方式共享权重
+
+用法：
+    python serve_workers.py --workers 4 --port 8000 --preload codegen
+
+每个工作进程运行独立的 Uvicorn 服务、推理线程、批量调度器和缓存，共同监听同一个端口，由内核分配连接。
+权重页只在主进程中写入一次，工作进程只读，因此不会被复制；每多一个工作进程只增加 KV 缓存、激活值和
+Python 对象等私有内存（见 /metrics 中的 codegen_process_memory_mb）。
+设置 CODEGEN_CACHE_PATH 时，各工作进程的结果缓存分别保存到 <路径>.worker<编号>，重启后的工作进程读取同编号的文件。
+需要 os.fork，仅支持 Linux / macOS；Windows 上请直接使用 uvicorn 单进程部署。
+"""
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+# 主进程中不使用分词器的多线程，避免 fork 后子进程中的 Rust 线程池状态不一致
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+logger = logging.getLogger("serve_workers")
+
+
+def create_socket(host, port):
+    """在主进程中创建监听套接字，所有工作进程共享"""
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(index, sock, args):
+    """工作进程入口：设置线程数后在共享套接字上运行 Uvicorn，不返回"""
+    import torch
+    import uvicorn
+    import generate_code_backend
+
+    # 各进程平分 CPU 核心，避免多个进程的计算线程互相争抢
+    torch.set_num_threads(args.threads)
+    # 多个进程写同一个缓存文件会互相覆盖，每个工作进程使用自己的文件；fork 前主进程读取的内容作为各进程的初始缓存
+    result_cache = generate_code_backend.result_cache
+    if result_cache.path:
+        result_cache.path = f"{result_cache.path}.worker{index}"
+        if os.path.exists(result_cache.path):
+            result_cache.load()
+    config = uvicorn.Config(generate_code_backend.app, log_level=args.log_level, timeout_keep_alive=30)
+    server = uvicorn.Server(config)
+    # 子进程继承了主进程的信号处理函数，换成只通知服务退出：uvicorn 正常退出后会重新触发收到的信号，
+    # 默认处理会直接结束进程，来不及保存缓存
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: setattr(server, "should_exit", True))
+    logger.info(f"工作进程 {index} 启动: pid={os.getpid()}, 计算线程数 {args.threads}")
+    server.run(sockets=[sock])
+    # os._exit 不执行 atexit 注册的函数，退出前手动保存结果缓存
+    result_cache.save()
+    os._exit(0)
+
+
+def spawn_worker(index, sock, args):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_worker(index, sock, args)
+        except BaseException as e:
+            logger.error(f"工作进程 {index} 异常退出: {e}")
+        finally:
+            os._exit(1)
+    return pid
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多进程部署 CodeGen 后端，工作进程共享模型权重")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=2, help="工作进程数")
+    parser.add_argument("--threads", type=int, default=0, help="每个工作进程的计算线程数，默认平分 CPU 核心")
+    parser.add_argument("--preload", default="", help="fork 前加载的模型（逗号分隔），默认加载默认模型")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if not hasattr(os, "fork"):
+        sys.exit("多进程共享权重需要 os.fork，当前系统不支持，请使用单进程部署")
+    if args.threads <= 0:
+        args.threads = max(1, (os.cpu_count() or 1) // args.workers)
+
+    # fork 前不能做任何推理：OpenMP 线程池在 fork 后的子进程中不可用，预热改为在各工作进程中首次请求时进行
+    os.environ["CODEGEN_WARMUP"] = "0"
+    import generate_code_backend
+    from model_registry import process_memory_mb
+
+    registry = generate_code_backend.registry
+    names = [name.strip() for name in args.preload.split(",") if name.strip()] or [registry.default_model]
+    for name in names:
+        registry.get(name)
+    for loaded in registry.loaded():
+        # 推理只读取权重，关闭梯度后工作进程不会写这些页
+        for parameter in loaded.model.parameters():
+            parameter.requires_grad_(False)
+    logger.info(f"主进程已加载模型 {', '.join(names)}，内存 {process_memory_mb()['rss']:.0f} MB")
+
+    # 冻结现有对象，避免工作进程中的垃圾回收改写这些对象头而触发写时复制
+    gc.collect()
+    gc.freeze()
+
+    sock = create_socket(args.host, args.port)
+    workers = {}
+    for index in range(args.workers):
+        workers[spawn_worker(index, sock, args)] = index
+    logger.info(f"已启动 {args.workers} 个工作进程，监听 {args.host}:{args.port}")
+
+    stopping = False
+
+    def shutdown(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    # 监督工作进程：异常退出时重新 fork，新进程同样共享主进程中的权重
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        index = workers.pop(pid, None)
+        if index is None or stopping:
+            continue
+        logger.warning(f"工作进程 {index} (pid={pid}) 退出，状态 {status}，重新启动")
+        time.sleep(1)
+        workers[spawn_worker(index, sock, args)] = index
+    sock.close()
+
+
+if __name__ == '__main__':
+    main()
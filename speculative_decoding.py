@@ -0,0 +1,80 @@
+import threading
+import time
+
+from transformers import StoppingCriteriaList
+
+from metrics import GenerationTimer
+
+
+class SpeculativeStats:
+    """投机解码统计：验证轮数、生成的 token 数和耗时（线程安全）
+
+    每轮草稿模型提出 num_assistant_tokens 个 token，主模型一次前向验证后接受其中一部分并再生成 1 个 token，
+    因此 接受的草稿 token 数 = 生成 token 数 - 轮数
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.generations = 0
+        self.rounds = 0
+        self.drafted = 0
+        self.tokens = 0
+        self.seconds = 0.0
+        self.baseline_speed = None  # 不使用草稿模型时主模型的解码速度（tokens/s），加载时测量
+
+    def record(self, rounds, tokens, num_assistant_tokens, seconds):
+        with self._lock:
+            self.generations += 1
+            self.rounds += rounds
+            self.drafted += rounds * num_assistant_tokens
+            self.tokens += tokens
+            self.seconds += seconds
+
+    def snapshot(self):
+        with self._lock:
+            accepted = max(0, self.tokens - self.rounds)
+            speed = self.tokens / self.seconds if self.seconds else 0.0
+            return {
+                "generations": self.generations,
+                "rounds": self.rounds,
+                "tokens": self.tokens,
+                # 按每轮提出 num_assistant_tokens 个 token 计算，接近最大长度或生成结束符时实际提出的更少
+                "acceptance_rate": accepted / self.drafted if self.drafted else 0.0,
+                "tokens_per_round": self.tokens / self.rounds if self.rounds else 0.0,
+                "tokens_per_second": speed,
+                "baseline_tokens_per_second": self.baseline_speed,
+                "speedup": speed / self.baseline_speed if self.baseline_speed and speed else None
+            }
+
+
+class DraftModel:
+    """辅助（投机）解码：小模型逐个提出候选 token，主模型一次前向验证
+
+    贪心解码时输出与主模型单独解码完全一致；采样时 transformers 使用投机采样，输出分布不变。
+    只用于单条序列生成，草稿模型必须与主模型使用相同的词表
+    """
+
+    def __init__(self, model, num_assistant_tokens=5):
+        self.model = model
+        self.num_assistant_tokens = num_assistant_tokens
+        self.stats = SpeculativeStats()
+        # transformers 从草稿模型的 generation_config 读取草稿参数；固定草稿长度并关闭按置信度提前结束，
+        # 每轮都提出 num_assistant_tokens 个 token，接受率才能用来调整草稿长度
+        model.generation_config.num_assistant_tokens = num_assistant_tokens
+        model.generation_config.num_assistant_tokens_schedule = "constant"
+        model.generation_config.assistant_confidence_threshold = 0
+
+    def generate_kwargs(self):
+        return {"assistant_model": self.model}
+
+    def generate(self, model, inputs, **generate_kwargs):
+        input_length = inputs["input_ids"].shape[1]
+        # 停止条件在每轮验证后调用一次，借此统计验证轮数
+        rounds = GenerationTimer(input_length)
+        stopping_criteria = StoppingCriteriaList(list(generate_kwargs.pop("stopping_criteria", None) or []) + [rounds])
+        start = time.perf_counter()
+        output_ids = model.generate(**inputs, stopping_criteria=stopping_criteria, **self.generate_kwargs(),
+                                    **generate_kwargs)
+        self.stats.record(rounds.steps, output_ids.shape[1] - input_length, self.num_assistant_tokens,
+                          time.perf_counter() - start)
+        return output_ids
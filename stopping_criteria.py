@@ -0,0 +1,195 @@
+import re
+import threading
+
+import torch
+from transformers import StoppingCriteria
+
+# 新的顶层定义：第 0 列的 def / async def / class / 装饰器
+TOP_LEVEL_DEF_PATTERN = re.compile(r"^(?:async\s+def\s|def\s|class\s|@)", re.M)
+# 空行（只包含空白字符的行）
+BLANK_LINE_PATTERN = re.compile(r"\n[ \t]*\n")
+# 回到第 0 列但仍属于同一代码块的行
+BLOCK_CONTINUATIONS = (")", "]", "}", "else", "elif", "except", "finally")
+BRACKET_PAIRS = {"(": ")", "[": "]", "{": "}"}
+
+
+def _starts_at_line_start(prompt):
+    """生成文本的第一个字符是否位于第 0 列"""
+    return not prompt or prompt.endswith("\n")
+
+
+def _bracket_depth(text, depth=0):
+    """粗略计算括号嵌套深度，跳过字符串和注释，返回 (深度, 每个字符处理后的深度列表)"""
+    depths = []
+    quote = None
+    in_comment = False
+    for ch in text:
+        if in_comment:
+            if ch == "\n":
+                in_comment = False
+        elif quote:
+            if ch == quote or ch == "\n":
+                quote = None
+        elif ch in "'\"":
+            quote = ch
+        elif ch == "#":
+            in_comment = True
+        elif ch in BRACKET_PAIRS:
+            depth += 1
+        elif ch in ")]}":
+            depth = max(0, depth - 1)
+        depths.append(depth)
+    return depth, depths
+
+
+def stop_at_top_level_def(prompt, text):
+    """出现新的顶层 def / class 时停止，返回截断位置，未命中返回 -1"""
+    for match in TOP_LEVEL_DEF_PATTERN.finditer(text):
+        pos = match.start()
+        if pos == 0 and not _starts_at_line_start(prompt):
+            continue  # 位于提示最后一行的中间，不是第 0 列
+        if text[:pos].strip():
+            return pos
+    return -1
+
+
+def stop_at_dedent(prompt, text):
+    """缩进块结束、重新回到第 0 列时停止"""
+    last_line = prompt.rstrip("\n").rsplit("\n", 1)[-1]
+    in_block = last_line[:1] in (" ", "\t") or last_line.rstrip().endswith(":")
+    at_line_start = _starts_at_line_start(prompt)
+    lines = text.split("\n")
+    pos = 0
+    for index, line in enumerate(lines):
+        if line.strip():
+            if at_line_start and line[0] not in " \t":
+                # 最后一行尚未生成完整时，可能是 else / except 等关键字的前缀，需要继续等待
+                partial = index == len(lines) - 1 and any(c.startswith(line) for c in BLOCK_CONTINUATIONS)
+                if in_block and not partial and not line.startswith(BLOCK_CONTINUATIONS):
+                    return pos
+            elif at_line_start:
+                in_block = True
+            elif line.rstrip().endswith(":"):
+                in_block = True
+        at_line_start = True
+        pos += len(line) + 1
+    return -1
+
+
+def stop_at_blank_line(prompt, text):
+    """函数体后出现空行时停止"""
+    match = BLANK_LINE_PATTERN.search(text)
+    if match and text[:match.start()].strip():
+        return match.start()
+    return -1
+
+
+def stop_at_balanced_brackets(prompt, text):
+    """提示中未闭合的括号全部闭合后，在该行结束处停止（该行以冒号开启新代码块时除外）"""
+    depth, _ = _bracket_depth(prompt)
+    if depth == 0:
+        return -1
+    _, depths = _bracket_depth(text, depth)
+    if 0 not in depths:
+        return -1
+    newline = text.find("\n", depths.index(0))
+    if newline == -1 or text[:newline].rstrip().endswith(":"):
+        return -1
+    return newline
+
+
+# 生成完整函数：空行、缩进结束或新的顶层定义都表示函数已完成
+FUNCTION_STOP_RULES = {
+    "blank_line": stop_at_blank_line,
+    "dedent": stop_at_dedent,
+    "top_level_def": stop_at_top_level_def,
+}
+# 代码补全：补全到当前代码单元结束
+COMPLETION_STOP_RULES = {
+    "top_level_def": stop_at_top_level_def,
+    "dedent": stop_at_dedent,
+    "balanced_brackets": stop_at_balanced_brackets,
+}
+
+
+def find_stop(prompt, text, rules):
+    """按规则查找最早的截断位置，返回 (位置, 规则名)，未命中返回 (-1, None)"""
+    stop_pos, stop_rule = -1, None
+    for name, rule in rules.items():
+        pos = rule(prompt, text)
+        if pos != -1 and (stop_pos == -1 or pos < stop_pos):
+            stop_pos, stop_rule = pos, name
+    return stop_pos, stop_rule
+
+
+def safe_length(prompt, text):
+    """流式输出时可以安全发送的文本长度
+
+    所有规则都只会在行首或换行处截断，因此末尾的空白字符、以及从第 0 列开始的未完成行暂不发送
+    """
+    safe = len(text.rstrip())
+    line_start = text.rfind("\n", 0, safe) + 1
+    if line_start > 0 or _starts_at_line_start(prompt):
+        if text[line_start:line_start + 1] not in (" ", "\t"):
+            safe = len(text[:line_start].rstrip())
+    return safe
+
+
+class StopStats:
+    """各停止条件的命中次数和节省的 token 数（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = {}
+        self.tokens_saved = {}
+
+    def record(self, rule, tokens_saved):
+        with self._lock:
+            self.hits[rule] = self.hits.get(rule, 0) + 1
+            self.tokens_saved[rule] = self.tokens_saved.get(rule, 0) + tokens_saved
+
+    def snapshot(self):
+        with self._lock:
+            return {"hits": dict(self.hits), "tokens_saved": dict(self.tokens_saved)}
+
+
+stop_stats = StopStats()
+
+
+class CodeStoppingCriteria(StoppingCriteria):
+    """每生成一个 token 解码各序列的新增文本，代码单元完整后单独停止该序列"""
+
+    def __init__(self, tokenizer, prompts, input_length, rules, max_new_tokens, stats=stop_stats):
+        self.tokenizer = tokenizer
+        self.prompts = prompts  # 与 input_ids 的行一一对应
+        self.input_length = input_length
+        self.rules = rules
+        self.max_new_tokens = max_new_tokens
+        self.stats = stats
+        self.stopped = [None] * len(prompts)  # 每条序列命中的规则名
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids.shape[1] - self.input_length
+        for i, row in enumerate(input_ids):
+            if self.stopped[i] is not None:
+                continue
+            text = self.tokenizer.decode(row[self.input_length:], skip_special_tokens=True)
+            _, rule = find_stop(self.prompts[i], text, self.rules)
+            if rule is not None:
+                self.stopped[i] = rule
+                self.stats.record(rule, max(0, self.max_new_tokens - generated))
+        done = [rule is not None for rule in self.stopped]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class RowBudgetCriteria(StoppingCriteria):
+    """按行限制新 token 数：左填充的批次中各提示长度不同，每行按自己的预算单独停止，不受同批其他提示影响"""
+
+    def __init__(self, input_length, budgets):
+        self.input_length = input_length
+        self.budgets = budgets  # 与 input_ids 的行一一对应
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids.shape[1] - self.input_length
+        return torch.tensor([generated >= budget for budget in self.budgets], dtype=torch.bool,
+                            device=input_ids.device)
@@ -79,103 +79,395 @@
 # tokenizer.save_pretrained(model_save_path)
 #
 # print(f"✅ 完整模型已保存到：{model_save_path}")
+import argparse
+import contextlib
+import itertools
+import math
+import os
+import time
+
 import torch
-from transformers import T5ForConditionalGeneration, RobertaTokenizer, get_linear_schedule_with_warmup
-from peft import get_peft_model, LoraConfig
-from datasets import load_dataset
+from transformers import AutoTokenizer, T5ForConditionalGeneration, get_linear_schedule_with_warmup
+from peft import LoraConfig, get_peft_model, get_peft_model_state_dict, set_peft_model_state_dict
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
-from transformers import default_data_collator
-
-# 设置设备（优先使用 CUDA）
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-print("当前设备：", device)
-
-# 加载预训练模型（CodeT5-small）和 tokenizer
-model_name = "D:/PythonCode/CodeBERT/model/CodeT5-small"
-model = T5ForConditionalGeneration.from_pretrained(model_name)
-
-# 定义 LoRA 配置
-peft_config = LoraConfig(
-    task_type="SEQ_2_SEQ_LM",
-    r=8,  # LoRA 低秩维度
-    lora_alpha=32,
-    lora_dropout=0.1,
-)
-model = get_peft_model(model, peft_config)
-model.to(device)
-
-tokenizer = RobertaTokenizer.from_pretrained(model_name)
-
-# 加载数据集
-ds = load_dataset("google/code_x_glue_ct_code_to_text", "python")
-train_dataset = ds["train"]  # 25 万条数据
-
-
-# **修正批量预处理函数**
-def preprocess_function(sample):
-    """对 batch 数据进行预处理"""
-    return {
-        "input_ids": [tokenizer("summarize: " + c, truncation=True, max_length=256, padding="max_length")["input_ids"]
-                      for c in sample["code"]],
-        "labels": [tokenizer(d, truncation=True, max_length=64, padding="max_length")["input_ids"] for d in
-                   sample["docstring"]]
-    }
-
-
-# **使用 map() 进行批量预处理**
-train_dataset = train_dataset.map(preprocess_function, batched=True,
-                                  remove_columns=["id", "repo", "path", "func_name", "original_string", "language",
-                                                  "code", "code_tokens", "docstring", "docstring_tokens", "sha", "url"])
-
-# **创建 DataLoader**
-batch_size = 4
-train_dataloader = DataLoader(train_dataset, shuffle=True, batch_size=batch_size, collate_fn=default_data_collator)
-
-# **训练参数**
-num_epochs = 10
-learning_rate = 3e-5
-gradient_accumulation_steps = 8
-
-optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate)
-total_steps = len(train_dataloader) * num_epochs
-scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=int(0.1 * total_steps),
-                                            num_training_steps=total_steps)
-
-# **训练循环**
-print("🚀 开始训练……")
-
-scaler = torch.cuda.amp.GradScaler()  # FP16 训练
-
-for epoch in range(num_epochs):
-    total_loss = 0.0
+
+from codet5_data import (TrainingBatches, build_collator, cached_stream, load_code_to_text, num_examples,
+                         padding_counts, preprocess_cached, tokenized_stream)
+from codet5_precision import PRECISIONS, PrecisionEngine, configure_threads, maybe_compile
+from codet5_checkpoint import (CheckpointManager, load_checkpoint, restore_training_state, rng_state, set_rng_state,
+                               training_state)
+from codet5_distributed import DistributedContext
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="LoRA 微调 CodeT5-small（代码摘要）",
+        epilog="多进程数据并行：torchrun --standalone --nproc_per_node=4 train_codeT5.py ..."
+    )
+    parser.add_argument("--model-path", default="D:/PythonCode/CodeBERT/model/CodeT5-small")
+    parser.add_argument("--output-dir", default="D:/PythonCode/CodeBERT/model/finetuned_codet5_small")
+    parser.add_argument("--dataset", default="google/code_x_glue_ct_code_to_text")
+    parser.add_argument("--dataset-config", default="python")
+    parser.add_argument("--train-file", help="本地 JSON Lines 训练数据（包含 code 和 docstring 字段），指定后不从 Hub 读取")
+    parser.add_argument("--max-train-samples", type=int, help="只使用前 N 条训练数据，用于调试")
+    parser.add_argument("--max-source-length", type=int, default=256)
+    parser.add_argument("--max-target-length", type=int, default=64)
+    parser.add_argument("--shuffle-buffer", type=int, default=10000, help="流式打乱的缓冲区大小，0 表示不打乱")
+    parser.add_argument("--cache-dir", help="预处理缓存目录：指定后先多进程分词整个数据集并缓存，之后的训练直接加载")
+    parser.add_argument("--preprocess-workers", type=int, default=os.cpu_count(), help="预处理进程数")
+    parser.add_argument("--group-by-length", action="store_true", help="按长度分组成批次，减少填充")
+    parser.add_argument("--bucket-size", type=int, default=50, help="按长度分组时每次排序的批次数")
+    parser.add_argument("--num-workers", type=int, default=0, help="DataLoader 工作进程数")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--learning-rate", type=float, default=3e-5)
+    parser.add_argument("--gradient-accumulation-steps", type=int, default=8)
+    parser.add_argument("--max-grad-norm", type=float, default=1.0, help="梯度裁剪的最大范数，0 表示不裁剪")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--precision", choices=PRECISIONS, default="auto",
+                        help="混合精度：auto 时 CUDA 用 bf16/fp16，CPU 有原生 bf16 指令时用 bf16，否则 fp32")
+    parser.add_argument("--compile", action="store_true", help="使用 torch.compile 编译模型")
+    parser.add_argument("--num-threads", type=int, help="PyTorch 计算线程数，默认由 PyTorch 决定")
+    parser.add_argument("--num-interop-threads", type=int, help="PyTorch 算子间并行线程数")
+    parser.add_argument("--log-every", type=int, default=100,
+                        help="每 N 个 batch 打印一次平均损失、学习率、梯度范数、步耗时和吞吐")
+    parser.add_argument("--checkpoint-dir", help="检查点目录，默认为 <output-dir>/checkpoints")
+    parser.add_argument("--save-steps", type=int, default=500, help="每 N 次参数更新保存一次检查点，0 表示不保存")
+    parser.add_argument("--save-total-limit", type=int, default=2, help="最多保留的检查点个数")
+    parser.add_argument("--resume", help="从检查点恢复训练：检查点目录，或 latest 表示检查点目录中最新的一个")
+    parser.add_argument("--validation-file", help="本地 JSON Lines 验证数据；未指定且不使用 --train-file 时读取 Hub 的验证集")
+    parser.add_argument("--max-eval-samples", type=int, default=2000, help="每次评估使用的验证样本数")
+    parser.add_argument("--eval-steps", type=int, default=500, help="每 N 次参数更新在验证集上评估一次，0 表示不评估")
+    parser.add_argument("--metric-for-best", choices=("loss", "accuracy"), default="loss",
+                        help="选择最佳模型和提前停止使用的验证指标")
+    parser.add_argument("--early-stopping-patience", type=int, default=0,
+                        help="验证指标连续 N 次评估没有提升时停止训练，0 表示不提前停止")
+    parser.add_argument("--early-stopping-threshold", type=float, default=0.0, help="视为提升的最小变化量")
+    return parser.parse_args()
+
+
+def build_dataset(args, tokenizer, split, data_file, max_samples, shuffle_buffer, dist_ctx):
+    """分词后的样本流和样本总数；指定 --cache-dir 时使用预处理缓存，否则流式读取并惰性分词
+
+    多进程训练时返回当前进程的分片，样本总数仍是所有进程合计
+    """
+    if args.cache_dir:
+        # 预处理缓存：第一次运行时多进程分词整个数据集，之后的运行（包括不同超参数的实验）直接内存映射加载；
+        # 多进程训练时由主进程写缓存，其他进程等待后直接加载
+        start_time = time.perf_counter()
+        with dist_ctx.main_process_first():
+            raw_dataset = load_code_to_text(args.dataset, args.dataset_config, split=split, data_file=data_file,
+                                            streaming=False)
+            if max_samples:
+                raw_dataset = raw_dataset.select(range(min(max_samples, len(raw_dataset))))
+            tokenized, cache_hit = preprocess_cached(raw_dataset, tokenizer, args.max_source_length,
+                                                     args.max_target_length, args.cache_dir,
+                                                     num_proc=args.preprocess_workers)
+        if dist_ctx.is_main:
+            print(f"{split} 预处理{'缓存命中' if cache_hit else '完成'}，耗时 {time.perf_counter() - start_time:.1f} 秒")
+        dataset = cached_stream(tokenized, shuffle_buffer=shuffle_buffer, seed=args.seed)
+        return dist_ctx.shard(dataset), len(tokenized)
+
+    # 流式加载数据集（25 万条数据）：不下载后整体分词，训练时边读边分词
+    raw_dataset = load_code_to_text(args.dataset, args.dataset_config, split=split, data_file=data_file)
+    num_samples = num_examples(raw_dataset, split)
+    if max_samples:
+        raw_dataset = raw_dataset.take(max_samples)
+        num_samples = min(num_samples, max_samples)
+    dataset = tokenized_stream(raw_dataset, tokenizer, args.max_source_length, args.max_target_length,
+                               shuffle_buffer=shuffle_buffer, seed=args.seed)
+    return dist_ctx.shard(dataset), num_samples
+
+
+def evaluate(model, dataloader, device, precision, dist_ctx):
+    """验证集上按 token 加权的平均损失和下一个 token 的预测准确率（多进程时各进程评估自己的分片后汇总）"""
+    model.eval()
+    total_loss = correct = total_tokens = 0
+    with torch.no_grad():
+        for batch in dataloader:
+            batch = {k: v.to(device) for k, v in batch.items()}
+            with precision.autocast():
+                outputs = model(**batch)
+            mask = batch["labels"] != -100
+            num_tokens = int(mask.sum())
+            total_loss += outputs.loss.item() * num_tokens
+            correct += int((outputs.logits.argmax(-1) == batch["labels"])[mask].sum())
+            total_tokens += num_tokens
     model.train()
+    total_loss, correct, total_tokens = dist_ctx.all_reduce_sum([total_loss, correct, total_tokens])
+    total_tokens = max(1, total_tokens)
+    return {"loss": total_loss / total_tokens, "accuracy": correct / total_tokens}
+
+
+def apply_gradients(parameters, optimizer, scheduler, precision, dist_ctx, num_batches, gradient_accumulation_steps,
+                    max_grad_norm, sync_gradients=False):
+    """一次参数更新：还原梯度缩放，按实际累积的 batch 数取平均，裁剪梯度后更新参数和学习率，返回裁剪前的梯度范数"""
+    precision.unscale(optimizer)
+    if sync_gradients:
+        dist_ctx.average_gradients(parameters)
+    if num_batches != gradient_accumulation_steps:
+        # 每个 batch 的损失都除以了 gradient_accumulation_steps，不足一组时还原为这几个 batch 的平均梯度
+        for p in parameters:
+            if p.grad is not None:
+                p.grad.mul_(gradient_accumulation_steps / num_batches)
+    grad_norm = torch.nn.utils.clip_grad_norm_(parameters, max_grad_norm if max_grad_norm > 0 else float("inf"))
+    precision.step(optimizer)
+    optimizer.zero_grad(set_to_none=True)
+    scheduler.step()
+    return grad_norm
+
+
+def improved(metric, best, name, threshold):
+    if best is None:
+        return True
+    if name == "loss":
+        return metric < best - threshold
+    return metric > best + threshold
+
+
+def main():
+    args = parse_args()
+    # 设置设备（优先使用 CUDA）；用 torchrun 启动时初始化进程组
+    dist_ctx = DistributedContext()
+    device = dist_ctx.setup()
+    log = print if dist_ctx.is_main else (lambda *a, **k: None)  # 只有主进程打印日志
+    # 各进程的 dropout 使用不同的随机数；LoRA 初始参数由 DDP 从主进程广播
+    torch.manual_seed(args.seed + dist_ctx.rank)
+    num_threads, num_interop_threads = configure_threads(args.num_threads or dist_ctx.default_num_threads(),
+                                                         args.num_interop_threads)
+    precision = PrecisionEngine(device, args.precision)
+    log(f"当前设备：{device}，精度 {precision.precision}，线程数 {num_threads}/{num_interop_threads}，"
+        f"进程数 {dist_ctx.world_size}")
+
+    # 加载预训练模型（CodeT5-small）和 tokenizer
+    model = T5ForConditionalGeneration.from_pretrained(args.model_path)
+
+    # 定义 LoRA 配置
+    peft_config = LoraConfig(
+        task_type="SEQ_2_SEQ_LM",
+        r=8,  # LoRA 低秩维度
+        lora_alpha=32,
+        lora_dropout=0.1,
+    )
+    model = get_peft_model(model, peft_config)
+    model.to(device)
+    # DDP 和编译后的模型只用于前向和反向，评估、合并 LoRA 和保存仍使用原模型
+    train_model = model
+    if dist_ctx.enabled:
+        train_model = DistributedDataParallel(model, device_ids=[device.index] if device.type == "cuda" else None)
+    ddp_model = train_model
+    train_model = maybe_compile(train_model, args.compile)
+
+    # 快速分词器（CodeT5 对应 RobertaTokenizerFast）整批分词时比逐条调用 Python 分词器快得多
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path, use_fast=True)
+
+    train_dataset, num_samples = build_dataset(args, tokenizer, "train", args.train_file, args.max_train_samples,
+                                               args.shuffle_buffer, dist_ctx)
+
+    # **创建 DataLoader**：批次由 TrainingBatches 组好（可选按长度分组），collator 按批动态填充，
+    # GPU 上填充到 8 的倍数以便使用 Tensor Core
+    train_batches = TrainingBatches(
+        train_dataset,
+        args.batch_size,
+        group_by_length=args.group_by_length,
+        bucket_size=args.bucket_size,
+        seed=args.seed
+    )
+    collator = build_collator(tokenizer, pad_to_multiple_of=8 if device.type == "cuda" else None)
+    train_dataloader = DataLoader(train_batches, batch_size=None, collate_fn=collator, num_workers=args.num_workers)
+
+    # 验证集：按长度分组以减少填充，顺序固定
+    eval_dataloader = None
+    if args.eval_steps and (args.validation_file or not args.train_file):
+        eval_dataset, _ = build_dataset(args, tokenizer, "validation", args.validation_file, args.max_eval_samples,
+                                        shuffle_buffer=0, dist_ctx=dist_ctx)
+        eval_batches = TrainingBatches(eval_dataset, args.batch_size, group_by_length=True,
+                                       bucket_size=args.bucket_size, seed=args.seed)
+        eval_dataloader = DataLoader(eval_batches, batch_size=None, collate_fn=collator)
+    # 每个进程只训练 1/world_size 的数据
+    steps_per_epoch = math.ceil(num_samples / dist_ctx.world_size / args.batch_size)
+
+    # **训练参数**
+    num_epochs = args.epochs
+    gradient_accumulation_steps = args.gradient_accumulation_steps
+
+    parameters = [p for p in model.parameters() if p.requires_grad]  # 只有 LoRA 参数参与训练
+    optimizer = torch.optim.AdamW(parameters, lr=args.learning_rate)
+    # 学习率调度按参数更新次数计算：每 gradient_accumulation_steps 个 batch 更新一次，每个 epoch 末尾不足一组的也更新一次
+    updates_per_epoch = math.ceil(steps_per_epoch / gradient_accumulation_steps)
+    total_steps = updates_per_epoch * num_epochs
+    scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=int(0.1 * total_steps),
+                                                num_training_steps=total_steps)
+
+    # **检查点**：只在参数更新之后保存（此时没有累积到一半的梯度），恢复时跳过本 epoch 已训练的批次
+    checkpoints = CheckpointManager(args.checkpoint_dir or os.path.join(args.output_dir, "checkpoints"),
+                                    keep=args.save_total_limit)
+    progress = {"epoch": 0, "batches": 0, "global_step": 0, "epoch_loss": 0.0, "best_metric": None,
+                "bad_evals": 0}
+    resume_rng = None
+    if args.resume:
+        resume_path = checkpoints.latest() if args.resume == "latest" else args.resume
+        if resume_path is None:
+            log("⚠️ 没有找到检查点，从头开始训练")
+        else:
+            state = load_checkpoint(resume_path)
+            progress = restore_training_state(state, model, optimizer, scheduler, precision)
+            # 每个进程恢复自己的随机数状态（数据分片与进程数有关，进程数不变时才能精确恢复）
+            resume_rng = state["rng"][dist_ctx.rank % len(state["rng"])]
+            log(f"🔁 从 {resume_path} 恢复：epoch {progress['epoch'] + 1}，"
+                f"已训练 {progress['batches']} 个 batch，共 {progress['global_step']} 次参数更新")
+    global_step = progress["global_step"]
+    best_metric, bad_evals = progress["best_metric"], progress["bad_evals"]
+    best_dir = os.path.join(checkpoints.directory, "best")
+    should_stop = False
+
+    def after_update(epoch, batches, epoch_loss):
+        """每次参数更新后按步评估（保存最佳适配器、判断是否提前停止）和保存检查点，返回耗时"""
+        nonlocal best_metric, bad_evals, should_stop
+        start = time.perf_counter()
+        if eval_dataloader is not None and global_step % args.eval_steps == 0:
+            metrics = evaluate(model, eval_dataloader, device, precision, dist_ctx)
+            metric = metrics[args.metric_for_best]
+            log(f"📊 Step {global_step} 验证 - 损失: {metrics['loss']:.4f} - token 准确率: {metrics['accuracy']:.2%}")
+            if improved(metric, best_metric, args.metric_for_best, args.early_stopping_threshold):
+                best_metric, bad_evals = metric, 0
+                # 最佳适配器和检查点一样在后台写盘
+                if dist_ctx.is_main:
+                    checkpoints.save("best", {"adapter": get_peft_model_state_dict(model),
+                                              "global_step": global_step, "metrics": metrics})
+            else:
+                bad_evals += 1
+                should_stop = 0 < args.early_stopping_patience <= bad_evals
+
+        if args.save_steps and global_step % args.save_steps == 0:
+            # 各进程的参数和优化器状态相同，由主进程保存；随机数状态每个进程一份
+            rng_states = dist_ctx.all_gather_object(rng_state())
+            if dist_ctx.is_main:
+                checkpoints.save(f"checkpoint-{global_step}", training_state(
+                    model, optimizer, scheduler, precision, rng_states, epoch=epoch, batches=batches,
+                    global_step=global_step, epoch_loss=epoch_loss, best_metric=best_metric, bad_evals=bad_evals))
+        return time.perf_counter() - start
+
+    # **训练循环**
+    log(f"🚀 开始训练……（{num_samples} 条样本，每个进程每个 epoch {steps_per_epoch} 个 batch，"
+        f"共 {total_steps} 次参数更新）")
+
+    for epoch in range(progress["epoch"], num_epochs):
+        model.train()
+        train_batches.set_epoch(epoch)  # 每个 epoch 使用不同的打乱顺序
+        # 损失在设备上累加（未除以 gradient_accumulation_steps），打印时才同步到 CPU
+        total_loss = torch.zeros((), device=device)
+        window_loss = torch.zeros((), device=device)
+        # 吞吐统计：样本数、有效 token 数和填充后的 token 数
+        samples = real_tokens = padded_tokens = 0
+        window_samples = window_tokens = window_batches = 0
+        grad_norm = None
+        pending = 0  # 已累积梯度、尚未更新参数的 batch 数
+
+        batches = iter(train_dataloader)
+        batches_done = 0
+        if resume_rng is not None:
+            # 数据顺序只由 seed 和 epoch 决定：跳过已训练的批次后恢复随机数状态（dropout），与不中断的训练完全一致
+            batches_done = progress["batches"]
+            total_loss += progress["epoch_loss"]
+            for _ in itertools.islice(batches, batches_done):
+                pass
+            set_rng_state(resume_rng)
+            resume_rng = None
+        first_batch = batches_done
+        start_time = window_start = time.perf_counter()
+
+        for step, batch in enumerate(dist_ctx.lockstep(batches), start=first_batch):
+            batch_samples = batch["input_ids"].shape[0]
+            real, padded = padding_counts(batch)
+            samples += batch_samples
+            real_tokens += real
+            padded_tokens += padded
+            window_samples += batch_samples
+            window_tokens += real
+            batch = {k: v.to(device) for k, v in batch.items()}
+
+            boundary = (step + 1) % gradient_accumulation_steps == 0
+            # 多进程时只在参数更新前的最后一个 batch 同步梯度，其余 batch 只在本进程累积
+            sync = ddp_model.no_sync() if dist_ctx.enabled and not boundary else contextlib.nullcontext()
+            with sync:
+                with precision.autocast():  # **混合精度（按设备选择，fp32 时不启用）**
+                    outputs = train_model(**batch)
+                    loss = outputs.loss / gradient_accumulation_steps  # 处理梯度累积
+
+                precision.backward(loss)
+            pending += 1
+            batches_done = step + 1
+            total_loss += outputs.loss.detach().float()
+            window_loss += outputs.loss.detach().float()
+            window_batches += 1
+
+            if boundary:  # **累积多个 batch 后更新**
+                grad_norm = apply_gradients(parameters, optimizer, scheduler, precision, dist_ctx, pending,
+                                            gradient_accumulation_steps, args.max_grad_norm)
+                pending = 0
+                global_step += 1
+                # 评估和保存检查点的时间不计入吞吐
+                paused = after_update(epoch, batches_done, total_loss.item())
+                start_time += paused
+                window_start += paused
+
+            if batches_done % args.log_every == 0:
+                now = time.perf_counter()
+                window = now - window_start
+                # 损失为本进程最近 log_every 个 batch 的平均值，吞吐按所有进程合计
+                all_samples, all_tokens, all_real, all_padded = dist_ctx.all_reduce_sum(
+                    [window_samples, window_tokens, real_tokens, padded_tokens])
+                norm = f"{grad_norm.item():.3f}" if grad_norm is not None else "-"
+                log(f"Epoch {epoch + 1}/{num_epochs} - Step {batches_done}/{steps_per_epoch} - "
+                    f"更新 {global_step}/{total_steps} - Loss: {window_loss.item() / window_batches:.4f} - "
+                    f"学习率 {scheduler.get_last_lr()[0]:.2e} - 梯度范数 {norm} - "
+                    f"{window / window_batches * 1000:.0f} ms/步 - {all_tokens / window:.0f} tokens/秒 - "
+                    f"{all_samples / window:.1f} 样本/秒 - 填充比例 {1 - all_real / all_padded:.1%}")
+                window_loss.zero_()
+                window_samples = window_tokens = window_batches = 0
+                window_start = now
 
-    for step, batch in enumerate(train_dataloader):
-        batch = {k: v.to(device) for k, v in batch.items()}
+            if should_stop:
+                log(f"⏹️ 验证{args.metric_for_best}连续 {bad_evals} 次评估没有提升，提前停止训练")
+                break
 
-        with torch.cuda.amp.autocast():  # **启用混合精度**
-            outputs = model(**batch)
-            loss = outputs.loss / gradient_accumulation_steps  # 处理梯度累积
+        if pending:
+            # 本 epoch 末尾不足 gradient_accumulation_steps 的 batch 也更新一次参数；
+            # 这些 batch 都在 no_sync 中完成，多进程时需要手动同步梯度
+            apply_gradients(parameters, optimizer, scheduler, precision, dist_ctx, pending,
+                            gradient_accumulation_steps, args.max_grad_norm, sync_gradients=dist_ctx.enabled)
+            global_step += 1
+            start_time += after_update(epoch, batches_done, total_loss.item())
 
-        scaler.scale(loss).backward()
+        elapsed = time.perf_counter() - start_time
+        avg_loss = total_loss.item() / max(1, batches_done)
+        samples, real_tokens, padded_tokens = dist_ctx.all_reduce_sum([samples, real_tokens, padded_tokens])
+        log(f"✅ Epoch {epoch + 1}/{num_epochs} 完成 - 平均损失: {avg_loss:.4f} - 共 {global_step} 次参数更新 - "
+            f"填充比例 {1 - real_tokens / max(1, padded_tokens):.1%} - {samples / elapsed:.1f} 样本/秒 - "
+            f"{real_tokens / elapsed:.0f} tokens/秒")
+        if should_stop:
+            break
 
-        if (step + 1) % gradient_accumulation_steps == 0:  # **累积多个 batch 后更新**
-            scaler.step(optimizer)
-            scaler.update()
-            optimizer.zero_grad()
-            scheduler.step()
+    dist_ctx.cleanup()
+    if not dist_ctx.is_main:
+        return
 
-        total_loss += loss.item()
+    checkpoints.wait()
+    if best_metric is not None and os.path.exists(best_dir):
+        # 使用验证指标最好的适配器
+        best = load_checkpoint(best_dir)
+        set_peft_model_state_dict(model, best["adapter"])
+        print(f"使用第 {best['global_step']} 次参数更新时的最佳适配器（验证{args.metric_for_best} {best_metric:.4f}）")
 
-        if (step + 1) % 100 == 0:
-            print(f"Epoch {epoch + 1}/{num_epochs} - Step {step + 1}/{len(train_dataloader)} - Loss: {loss.item():.4f}")
+    # **合并 LoRA 适配器并保存完整模型**
+    model = model.merge_and_unload()
+    model.save_pretrained(args.output_dir)
+    tokenizer.save_pretrained(args.output_dir)
 
-    avg_loss = total_loss / len(train_dataloader)
-    print(f"✅ Epoch {epoch + 1}/{num_epochs} 完成 - 平均损失: {avg_loss:.4f}")
+    print(f"✅ 完整模型已保存！")
 
-# **合并 LoRA 适配器并保存完整模型**
-model = model.merge_and_unload()
-model.save_pretrained("D:/PythonCode/CodeBERT/model/finetuned_codet5_small")
-tokenizer.save_pretrained("D:/PythonCode/CodeBERT/model/finetuned_codet5_small")
 
-print(f"✅ 完整模型已保存！")
+if __name__ == '__main__':
+    main()